@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""
+async_engine.py - motor asyncio de log_audit (AUDIT_ENGINE=asyncio).
+Mismo pipeline que el modo con threads (tail -> pending por clave canónica -> resolución
+fileid/path/username hasta RESOLVE_WAIT -> dedupe -> insert por lotes), pero con timers
+de asyncio en vez de sleep y asyncpg para el pool y los inserts.
+Parsers, SQL, dedupe, correlación y caches se comparten con log_audit.
+"""
+import asyncio, os, signal, traceback
+from datetime import timezone
+
+try:
+    import asyncpg
+except Exception as e:
+    print("Missing asyncpg:", e); raise
+
+import log_audit as la
+import metrics
+import tracing
+from log_ingest import LogTailer, mark_done
+
+INSERT_COLUMNS = ['ts', 'username', 'ip', 'method', 'original_resource', 'resource', 'object_id',
+                  'status', 'size', 'user_agent', 'referrer', 'raw_line', 'event_type']
+
+def _pg(sql):
+    # placeholders de psycopg2 (%s) -> asyncpg ($1, $2, ...)
+    parts = sql.split('%s')
+    out = [parts[0]]
+    for i, part in enumerate(parts[1:]):
+        out.append('$%d' % (i + 1))
+        out.append(part)
+    return ''.join(out)
+
+FILEID_BY_PATH_SQL = _pg(la.FILEID_BY_PATH_SQL)
+PATH_BY_FILEID_SQL = _pg(la.PATH_BY_FILEID_SQL)
+FNAME_ILIKE_SQL = _pg(la.FNAME_ILIKE_SQL)
+FNAME_TRGM_SQL = _pg(la.FNAME_TRGM_SQL)
+USERNAMES_BY_FILEIDS_SQL = _pg(la.USERNAMES_BY_FILEIDS_SQL)
+USERNAME_BY_PATH_SQL = _pg(la.USERNAME_BY_PATH_SQL)
+SIMILAR_BY_OBJECT_SQL = _pg(la.SIMILAR_BY_OBJECT_SQL)
+SIMILAR_BY_RESOURCE_SQL = _pg(la.SIMILAR_BY_RESOURCE_SQL)
+INSERT_ROW_SQL = "INSERT INTO audit_events (%s) VALUES (%s) ON CONFLICT DO NOTHING" % (
+    ", ".join(INSERT_COLUMNS), ", ".join("$%d" % (i + 1) for i in range(len(INSERT_COLUMNS))))
+
+def _as_utc(ts):
+    # asyncpg necesita datetimes con zona para timestamptz
+    if ts is not None and ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts
+
+def _row(row):
+    return (_as_utc(row[0]),) + tuple(row[1:])
+
+# --- consultas (mismo orden y semántica que las de log_audit) ---
+async def find_fileid_and_path(conn, path):
+    if not path:
+        return (None, None)
+    if la.filecache_mirror.ready:
+        r = la.filecache_mirror.lookup(path)
+        # miss: igual que en log_audit, seguir con path_cache / DB
+        if r[0] is not None:
+            return r
+    cached = la.path_cache.get(path)
+    if cached is not la.TTLCache.MISS:
+        return cached
+    try:
+        r = await _find_fileid_and_path_db(conn, path)
+    except Exception as e:
+        print("find_fileid_and_path error:", e)
+        return (None, None)
+    la.path_cache.put(path, r, negative=r[0] is None)
+    return r
+
+@metrics.timed("find_fileid_and_path")
+async def _find_fileid_and_path_db(conn, path):
+    p = path.lstrip('/')
+    for cand in (p, path):
+        r = await conn.fetchrow(FILEID_BY_PATH_SQL, cand)
+        if r:
+            return (r[0], r[1])
+    # fallback por filename
+    fname = p.split('/')[-1]
+    if fname:
+        r = await conn.fetchrow(FNAME_TRGM_SQL if la.filename_lookup_mode == "trgm" else FNAME_ILIKE_SQL, '%' + fname + '%')
+        if r:
+            return (r[0], r[1])
+    return (None, None)
+
+@metrics.timed("path_for_fileid")
+async def path_for_fileid(conn, object_id):
+    p = la.filecache_mirror.path_for_fileid(object_id) if la.filecache_mirror.ready else None
+    if not p:
+        p = await conn.fetchval(PATH_BY_FILEID_SQL, object_id)
+    if p:
+        return '/' + p if not p.startswith('/') else p
+    return None
+
+@metrics.timed("find_usernames_for_fileids")
+async def find_usernames_for_fileids(conn, fileids):
+    fileids = sorted(set(int(f) for f in fileids if f))
+    if not fileids:
+        return {}
+    by_fid = {}
+    for r in await conn.fetch(USERNAMES_BY_FILEIDS_SQL, fileids):
+        by_fid.setdefault(r[0], []).append(r[1])
+    return dict((fid, la._pick_username(unames)) for fid, unames in by_fid.items())
+
+@metrics.timed("find_username_for_fileid_or_path")
+async def find_username_for_path(conn, path):
+    if not path:
+        return None
+    try:
+        rows = await conn.fetch(USERNAME_BY_PATH_SQL, path, '%' + path + '%')
+        if rows:
+            return la._pick_username([r[0] for r in rows])
+    except Exception as e:
+        print("find_username_for_fileid_or_path error:", e)
+    return None
+
+@metrics.timed("already_similar")
+async def already_similar(conn, row):
+    ts, username, ip, method, resource, object_id = _as_utc(row[0]), row[1], row[2], row[3], row[5], row[6]
+    if object_id and await conn.fetchval(SIMILAR_BY_OBJECT_SQL, object_id, username, ip, method, ts, la.DEDUPE_SECONDS):
+        return True
+    return bool(await conn.fetchval(SIMILAR_BY_RESOURCE_SQL, resource, resource, username, ip, method, ts, la.DEDUPE_SECONDS))
+
+class AsyncWriter:
+    """Igual que AuditWriter: lotes por tamaño o tiempo, COPY (o INSERT ... ON CONFLICT con dedupe_bucket)."""
+    _STOP = object()
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.q = asyncio.Queue(maxsize=la.WRITE_QUEUE_MAX)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def put(self, row, check_db=False, ckpt=None, trace=None):
+        await self.q.put((row, check_db, ckpt, trace))
+
+    async def close(self):
+        if self.task is None:
+            return
+        await self.q.put(self._STOP)
+        await self.task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            if len(batch) >= la.WRITE_BATCH_SIZE:
+                # el último flush falló: no leer más hasta poder escribir
+                await asyncio.sleep(la.WRITE_FLUSH_INTERVAL)
+                if await self._flush(batch):
+                    batch = []
+                continue
+            try:
+                if batch:
+                    item = await asyncio.wait_for(self.q.get(), max(0, deadline - loop.time()))
+                else:
+                    item = await self.q.get()
+            except asyncio.TimeoutError:
+                item = None
+            if item is self._STOP:
+                while not self.q.empty():
+                    item = self.q.get_nowait()
+                    if item is not self._STOP:
+                        batch.append(item)
+                if batch and not await self._flush(batch):
+                    print("audit writer: %d events could not be written at shutdown" % len(batch))
+                return
+            if item is not None:
+                if not batch:
+                    deadline = loop.time() + la.WRITE_FLUSH_INTERVAL
+                batch.append(item)
+            if batch and (len(batch) >= la.WRITE_BATCH_SIZE or loop.time() >= deadline):
+                if await self._flush(batch):
+                    batch = []
+                else:
+                    deadline = loop.time() + la.WRITE_FLUSH_INTERVAL
+
+    @metrics.timed("writer_flush")
+    async def _flush(self, batch):
+        traces = [tr for _, _, _, tr in batch if tr]
+        for tr in traces:
+            tr.mark("queue")
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    rows = []
+                    for row, check_db, _, _ in batch:
+                        if check_db and not la.dedupe_unique_active and await already_similar(conn, row):
+                            continue
+                        rows.append(_row(row))
+                    inserted, failed = len(rows), 0
+                    if rows:
+                        try:
+                            # savepoint: si falla por los datos, fila por fila como AuditWriter
+                            async with conn.transaction():
+                                if la.dedupe_unique_active:
+                                    await conn.executemany(INSERT_ROW_SQL, rows)
+                                else:
+                                    await conn.copy_records_to_table('audit_events', records=rows, columns=INSERT_COLUMNS)
+                        except Exception as e:
+                            if la.db_error_is_transient(e):
+                                raise
+                            print("audit writer batch error, retrying row by row:", str(e).strip())
+                            inserted, failed = await self._insert_rows(conn, rows)
+            print("audit writer: flushed %d events (%d duplicates skipped, %d failed)" % (
+                inserted, len(batch) - inserted - failed, failed))
+            metrics.INSERT_BATCH_SIZE.observe(inserted)
+            metrics.DEDUPE_DROPPED.inc(len(batch) - inserted - failed, stage="db")
+            metrics.INSERT_FAILED.inc(failed)
+            mark_done(*[ckpt for _, _, ckpt, _ in batch])
+            la.checkpoints.save()
+            for tr in traces:
+                tr.mark("insert")
+                tracing.finish(tr, "written")
+            return True
+        except Exception as e:
+            print("audit writer flush error:", e)
+            traceback.print_exc()
+            return False
+
+    async def _insert_rows(self, conn, rows):
+        inserted = failed = 0
+        for row in rows:
+            try:
+                async with conn.transaction():
+                    status = await conn.execute(INSERT_ROW_SQL, *row)
+                inserted += status.endswith(" 1")
+            except Exception as e:
+                if la.db_error_is_transient(e):
+                    raise
+                failed += 1
+                print("audit writer: dropping event that cannot be inserted:", row[0], row[2], row[3],
+                      (row[4] or '')[:200], "-", str(e).strip())
+        return inserted, failed
+
+class AsyncResolver:
+    """
+    Pending por clave canónica con un timer (loop.call_later) por clave en vez de threads.
+    Las claves que vencen en la misma vuelta del loop se resuelven juntas (hasta RESOLVE_BATCH),
+    con a lo sumo RESOLVE_WORKERS lotes en curso. Reintentos con la.next_resolve_due y wake()
+    desde el app log, como ResolutionScheduler.
+    """
+    def __init__(self, pool, writer):
+        self.pool = pool
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.pending = {}
+        self.index = la.PendingIndex()
+        self.due = []
+        self.dispatch_scheduled = False
+        self.space = asyncio.Condition()
+        self.sem = asyncio.Semaphore(max(1, la.RESOLVE_WORKERS))
+        self.tasks = set()
+
+    async def submit(self, ev, ckpt=None, trace=None):
+        res = la.normalize_resource(ev.get('resource'))
+        for ign in la.IGNORE_PATTERNS:
+            if ign in (res or ''):
+                print("Skipping ignore pattern:", res)
+                mark_done(ckpt)
+                tracing.finish(trace, "ignored")
+                return
+        key, maybe_fid = la.canonical_key_for_resource(res)
+        if trace:
+            trace.key = key
+            trace.mark("canonicalize")
+        async with self.space:
+            await self.space.wait_for(lambda: key in self.pending or len(self.pending) < la.MAX_PENDING)
+            if key in self.pending:
+                self.pending[key]['last_seen'] = la.datetime.utcnow()
+                mark_done(ckpt)
+                tracing.finish(trace, "merged")
+                return
+            now = self.loop.time()
+            self.pending[key] = {'first_seen': la.datetime.utcnow(), 'last_seen': la.datetime.utcnow(), 'ev': ev.copy(), 'res': res,
+                                 'object_id': maybe_fid, 'resolved_path': None, 'ckpt': ckpt, 'trace': trace,
+                                 'deadline': now + la.RESOLVE_WAIT, 'final': False, 'timer': None,
+                                 'attempts': 0, 'busy': False, 'wake': False}
+            self.index.add(res, key)
+        self._schedule(key, 0)
+
+    def _schedule(self, key, delay):
+        st = self.pending.get(key)
+        if st is not None:
+            if st['timer'] is not None:
+                st['timer'].cancel()
+            st['timer'] = self.loop.call_later(delay, self._fire, key)
+
+    def wake(self, resource):
+        # se llama desde el loop (tail del app log / initial scan)
+        for key in self.index.keys_for(resource):
+            st = self.pending.get(key)
+            if st is None:
+                continue
+            metrics.RESOLUTION_WAKEUPS.inc()
+            if st['busy']:
+                st['wake'] = True
+            else:
+                self._schedule(key, 0)
+
+    def _fire(self, key):
+        st = self.pending.get(key)
+        if st is None:
+            return
+        st['busy'] = True
+        self.due.append(key)
+        if not self.dispatch_scheduled:
+            self.dispatch_scheduled = True
+            self.loop.call_soon(self._dispatch)
+
+    def _dispatch(self):
+        self.dispatch_scheduled = False
+        while self.due:
+            keys = self.due[:la.RESOLVE_BATCH]
+            del self.due[:la.RESOLVE_BATCH]
+            t = asyncio.ensure_future(self._run_batch(keys))
+            self.tasks.add(t)
+            t.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, keys):
+        items = [(k, self.pending[k]) for k in keys if k in self.pending]
+        done = set()
+        metrics.RESOLUTION_ATTEMPTS.inc(len(items))
+        async with self.sem:
+            for key, st in items:
+                if st['trace']:
+                    st['trace'].attempt()
+            # igual que en log_audit: el intento en el deadline consulta oc_activity antes del final
+            if items:
+                try:
+                    done = await self._attempt(items)
+                except Exception as e:
+                    print("resolver error:", e)
+                    traceback.print_exc()
+            finals = set()
+            for key, st in items:
+                if st['final'] and key not in done:
+                    try:
+                        await self._final(key, st)
+                    except Exception as e:
+                        print("resolver error:", key, e)
+                        mark_done(st['ckpt'])
+                        tracing.finish(st['trace'], "error")
+                    finals.add(key)
+            done |= finals
+        for key, st in items:
+            if key in done:
+                self.pending.pop(key, None)
+                self.index.discard(st['res'], key)
+                metrics.RESOLUTION_SECONDS.observe(self.loop.time() - (st['deadline'] - la.RESOLVE_WAIT),
+                                                   outcome="final" if key in finals else "resolved")
+            else:
+                if st['trace']:
+                    st['trace'].mark("resolve")
+                st['busy'] = False
+                st['attempts'] += 1
+                now = self.loop.time()
+                if st['wake']:
+                    st['wake'] = False
+                    due, st['final'] = now, now >= st['deadline']
+                else:
+                    due, st['final'] = la.next_resolve_due(st['attempts'], st['deadline'], now)
+                self._schedule(key, due - now)
+        if done:
+            async with self.space:
+                self.space.notify_all()
+
+    async def _insert(self, st):
+        tr = st['trace']
+        if tr:
+            tr.mark("resolve")
+        row = la.event_row(st['ev'], st['object_id'], st['resolved_path'])
+        if row is None:
+            return False
+        dup, check_db = la.dedupe.check_and_add(row[0], row[1], row[2], row[3], row[5], row[6])
+        if tr:
+            tr.mark("dedupe")
+        if dup:
+            metrics.DEDUPE_DROPPED.inc(stage="memory")
+            return False
+        await self.writer.put(row, check_db, st['ckpt'], tr)
+        return True
+
+    async def _attempt(self, items):
+        # misma lógica que log_audit._resolve_batch (también encola fuera del acquire)
+        done = set()
+        resolved = []
+        for key, st in items:
+            gu = la.guess_username(st['res'])
+            if gu:
+                st['ev']['username'] = gu
+        try:
+            async with self.pool.acquire() as conn:
+                for key, st in items:
+                    if not st['object_id']:
+                        fid, path = await find_fileid_and_path(conn, st['res'])
+                        if fid:
+                            st['object_id'] = fid
+                            st['resolved_path'] = '/' + path if path and not path.startswith('/') else path
+                    elif not st['resolved_path']:
+                        st['resolved_path'] = await path_for_fileid(conn, st['object_id'])
+                fids = [st['object_id'] for _, st in items if st['object_id']]
+                if la.activity_feed.ready:
+                    by_fid = la.activity_feed.usernames_for_fileids(fids)
+                    by_fid.update(await find_usernames_for_fileids(conn, [f for f in fids if f not in by_fid]))
+                else:
+                    by_fid = await find_usernames_for_fileids(conn, fids)
+                for key, st in items:
+                    uname = by_fid.get(st['object_id']) if st['object_id'] else None
+                    if not uname:
+                        if la.activity_feed.ready:
+                            uname = la.activity_feed.username_for_path(st['res'])
+                        else:
+                            uname = await find_username_for_path(conn, st['res'])
+                    if uname:
+                        st['ev']['username'] = uname
+                        resolved.append((key, st))
+        except Exception as e:
+            print("worker db resolution error:", e)
+        for key, st in resolved:
+            if await self._insert(st):
+                print("Inserted (resolved-db canonical):", key, st['ev']['username'], "->", st['resolved_path'] or st['res'])
+                done.add(key)
+        for key, st in items:
+            if key not in done and st['ev'].get('username'):
+                if await self._insert(st):
+                    print("Inserted (resolved-early):", key, st['ev'].get('username'), "->", st['resolved_path'] or st['res'])
+                    done.add(key)
+        return done
+
+    async def _final(self, key, st):
+        final_guess = la.guess_username(st['res'])
+        if final_guess:
+            st['ev']['username'] = final_guess
+        if not st['resolved_path'] and st['object_id']:
+            try:
+                async with self.pool.acquire() as conn:
+                    st['resolved_path'] = await path_for_fileid(conn, st['object_id'])
+            except Exception:
+                pass
+        if await self._insert(st):
+            print("Inserted (final canonical):", key, st['ev'].get('username'), "->", st['resolved_path'] or st['res'])
+        else:
+            mark_done(st['ckpt'])
+            tracing.finish(st['trace'], "dropped")
+
+    async def stop(self):
+        """Cancela timers, espera los lotes en curso y hace el intento final de lo que quede."""
+        for st in self.pending.values():
+            if st['timer'] is not None:
+                st['timer'].cancel()
+        self.due = []
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+        for key, st in list(self.pending.items()):
+            try:
+                await self._final(key, st)
+            except Exception as e:
+                print("resolver shutdown error:", key, e)
+                mark_done(st['ckpt'])
+                tracing.finish(st['trace'], "error")
+        self.pending.clear()
+        self.index.clear()
+
+    async def idle(self):
+        # para benchmarks: esperar a que no quede nada pendiente
+        while self.pending or self.tasks:
+            await asyncio.sleep(0.05)
+
+async def tail(tailer, on_line, log):
+    """Tail por polling sobre LogTailer (rotación/truncado incluidos) sin bloquear el loop."""
+    while True:
+        lines = tailer.poll()
+        if not lines:
+            await asyncio.sleep(la.TAIL_POLL_INTERVAL)
+            continue
+        metrics.LINES_READ.inc(len(lines), log=log)
+        for line, pos in zip(lines, tailer.positions):
+            await on_line(line, pos)
+
+async def run():
+    print("Audit starting (asyncio). ACCESS_LOG=", la.ACCESS_LOG, "APP_LOG=", la.NEXTCLOUD_APP_LOG)
+    la.ensure_table()
+    la.seed_dedupe()
+    pool = await asyncpg.create_pool(host=la.DB_HOST, database=la.DB_NAME, user=la.DB_USER, password=la.DB_PASS,
+                                     min_size=la.DB_POOL_MIN, max_size=la.DB_POOL_MAX, timeout=5)
+    writer = AsyncWriter(pool)
+    writer.start()
+    resolver = AsyncResolver(pool, writer)
+    la.resolution_wakers.append(resolver.wake)
+    metrics.PENDING.register(lambda: len(resolver.pending))
+    la.start_background_services()
+
+    la.checkpoints.load()
+    access_tracker = la.checkpoints.tracker(la.ACCESS_LOG)
+    app_tracker = la.checkpoints.tracker(la.NEXTCLOUD_APP_LOG)
+
+    async def on_access_line(line, pos):
+        tr = tracing.start()
+        ev = la.parse_apache_line(line)
+        if ev:
+            metrics.LINES_PARSED.inc(log="access")
+            if tr:
+                tr.mark("parse")
+            await resolver.submit(ev, access_tracker.begin(pos[0], pos[1], line) if access_tracker else None, tr)
+        elif access_tracker:
+            access_tracker.skip(pos[0], pos[1], line)
+
+    async def on_app_line(line, pos):
+        parsed = la.parse_nextcloud_app_line(line)
+        if parsed:
+            metrics.LINES_PARSED.inc(log="app")
+            la._recent_action_sink(parsed)
+        if app_tracker:
+            app_tracker.skip(pos[0], pos[1], line)
+
+    tailers = []
+    resumed = set()
+    for path, on_line, log in ((la.NEXTCLOUD_APP_LOG, on_app_line, "app"), (la.ACCESS_LOG, on_access_line, "access")):
+        if os.path.exists(path):
+            tailer = LogTailer(path)
+            saved = la.checkpoints.get(path)
+            if saved and tailer.resume(saved):
+                print("Resuming %s from checkpoint offset %d" % (path, saved["offset"]))
+                resumed.add(path)
+            tailers.append((tailer, on_line, log))
+            print("Watching log:", path)
+    if not tailers:
+        print("No logs to watch. Sleeping.")
+
+    # sin checkpoint: como antes, últimas líneas y luego desde el final
+    if la.NEXTCLOUD_APP_LOG not in resumed:
+        # preload recent actions to help guess usernames quickly
+        la.initial_scan_file(la.NEXTCLOUD_APP_LOG, la.parse_nextcloud_app_line, limit_lines=2000, sink=la._recent_action_sink,
+                             line_ts=la.app_line_ts)
+    if la.ACCESS_LOG not in resumed:
+        scanned = []
+        la.initial_scan_file(la.ACCESS_LOG, la.parse_apache_line, limit_lines=1000, sink=scanned.append, line_ts=la.apache_line_ts)
+        for ev in scanned:
+            await resolver.submit(ev)
+    tailers = [asyncio.ensure_future(tail(tailer, on_line, log)) for tailer, on_line, log in tailers]
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # shutdown: pending -> intento final -> writer -> flush síncrono
+    for t in tailers:
+        t.cancel()
+    await asyncio.gather(*tailers, return_exceptions=True)
+    await resolver.stop()
+    await writer.close()
+    la.checkpoints.save()
+    tracing.close()
+    await pool.close()
+
+def main():
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
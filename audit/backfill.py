@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+backfill.py - carga masiva de access.log históricos (rotados, comprimidos con gzip/bz2/zstd) en audit_events.
+Uso: python log_audit.py backfill --files /archivo/access.log.1 /archivo/access.log.2.gz ...
+
+En vez de pasar cada línea por pending y la resolución por polling del servicio en vivo:
+  1. las líneas se parsean en un pool de procesos (parse_apache_line, mismos filtros que en vivo)
+     y vuelven ya serializadas para COPY;
+  2. cada lote se carga con COPY en una tabla temporal (backfill_stage);
+  3. fileid/path se resuelven con joins contra oc_filecache (path exacto, luego nombre de archivo)
+     por resource distinto, y el username con un LATERAL sobre oc_activity: la actividad del
+     object_id más reciente al momento del evento, prefiriendo usuarios humanos;
+  4. el dedupe es un DELETE ... EXISTS contra audit_events y una pasada en orden de ts sobre las claves
+     del lote (como DedupeCache: cada evento contra el último conservado de su clave, no contra el
+     anterior descartado); lo que queda entra con un solo INSERT ... SELECT por lote.
+"""
+import io, os, time
+from collections import deque
+from multiprocessing import Pool
+
+import log_audit as la
+from log_ingest import open_log
+
+# líneas por tarea de parseo / eventos por lote de COPY + resolución
+BACKFILL_CHUNK = int(os.getenv("BACKFILL_CHUNK","20000"))
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH","200000"))
+
+STAGE_COLUMNS = ['ts', 'username', 'ip', 'method', 'original_resource', 'resource', 'object_id',
+                 'status', 'size', 'user_agent', 'referrer', 'raw_line', 'event_type']
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_value(v):
+    if v is None:
+        return '\\N'
+    if hasattr(v, 'isoformat'):
+        # naive -> UTC, como en el resto del servicio
+        return v.isoformat() if v.tzinfo else v.isoformat() + '+00:00'
+    return str(v).translate(_COPY_ESCAPES)
+
+def parse_chunk(lines):
+    """(en el pool) líneas -> (eventos, texto para COPY). PROPFIND e IGNORE_PATTERNS se descartan como en vivo."""
+    out = []
+    for line in lines:
+        ev = la.parse_apache_line(line)
+        if not ev:
+            continue
+        res = la.normalize_resource(ev.get('resource'))
+        if any(ign in (res or '') for ign in la.IGNORE_PATTERNS):
+            continue
+        _, maybe_fid = la.canonical_key_for_resource(res)
+        row = la.event_row(ev, maybe_fid)
+        if row is None:
+            continue
+        out.append('\t'.join(_copy_value(v) for v in row))
+    return len(out), ''.join(l + '\n' for l in out)
+
+def read_chunks(files, chunk_lines):
+    for path in files:
+        print("backfill: reading", path)
+        with open_log(path) as fh:
+            chunk = []
+            for line in fh:
+                chunk.append(line)
+                if len(chunk) >= chunk_lines:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+STAGE_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS backfill_stage AS
+SELECT %s FROM audit_events WITH NO DATA;
+CREATE TEMP TABLE IF NOT EXISTS backfill_paths (res text PRIMARY KEY, fname text, fileid bigint, path text);
+CREATE TEMP TABLE IF NOT EXISTS backfill_resolved AS
+SELECT 0::bigint AS rid, %s FROM audit_events WITH NO DATA;
+""" % (", ".join(STAGE_COLUMNS), ", ".join(STAGE_COLUMNS))
+
+RESOLVE_SQL = [
+    # object_id conocido por la URL (fileId=, /download/N, wopi): solo falta el path
+    """
+    UPDATE backfill_stage s SET resource = '/' || ltrim(f.path, '/')
+    FROM oc_filecache f
+    WHERE s.object_id IS NOT NULL AND f.fileid = s.object_id;
+    """,
+    "TRUNCATE backfill_paths;",
+    """
+    INSERT INTO backfill_paths (res, fname)
+    SELECT DISTINCT original_resource, regexp_replace(original_resource, '^.*/', '')
+    FROM backfill_stage WHERE object_id IS NULL AND original_resource IS NOT NULL;
+    """,
+    # path exacto, como find_fileid_and_path (oc_filecache.path no lleva '/' inicial; sin OR para poder usar hash join)
+    """
+    UPDATE backfill_paths p SET fileid = f.fileid, path = f.path
+    FROM oc_filecache f
+    WHERE f.path = ltrim(p.res, '/');
+    """,
+    # fallback por nombre de archivo: el fileid más alto, como el ILIKE de find_fileid_and_path
+    """
+    UPDATE backfill_paths p SET fileid = m.fileid, path = m.path
+    FROM (
+        SELECT DISTINCT ON (f.name) f.name, f.fileid, f.path
+        FROM oc_filecache f
+        WHERE f.name IN (SELECT fname FROM backfill_paths WHERE fileid IS NULL AND fname <> '')
+        ORDER BY f.name, f.fileid DESC
+    ) m
+    WHERE p.fileid IS NULL AND m.name = p.fname;
+    """,
+    """
+    UPDATE backfill_stage s SET object_id = p.fileid, resource = '/' || ltrim(p.path, '/')
+    FROM backfill_paths p
+    WHERE s.object_id IS NULL AND p.fileid IS NOT NULL AND s.original_resource = p.res;
+    """,
+]
+
+# username por oc_activity: la actividad del object_id más reciente al momento del evento, prefiriendo humanos
+USERNAME_SQL = """
+INSERT INTO backfill_resolved (rid, %s)
+SELECT row_number() OVER (), %s
+FROM (
+    SELECT s.ts, coalesce(s.username, act.username) AS username, %s
+    FROM backfill_stage s
+    LEFT JOIN LATERAL (
+        SELECT COALESCE(a."user", a.affecteduser) AS username
+        FROM oc_activity a
+        -- object_type: usa el índice (object_type, object_id) de oc_activity
+        WHERE s.username IS NULL AND a.object_type = 'files' AND a.object_id = s.object_id AND a.app = 'files'
+        ORDER BY a.timestamp <= extract(epoch from s.ts) + %%(window)s DESC,
+                 coalesce(trim(COALESCE(a."user", a.affecteduser)), '') <> ALL(%%(blacklist)s) DESC,
+                 a.timestamp DESC
+        LIMIT 1
+    ) act ON true
+) r;
+""" % (", ".join(STAGE_COLUMNS), ", ".join(STAGE_COLUMNS), ", ".join("s." + c for c in STAGE_COLUMNS[2:]))
+
+# duplicados de eventos ya guardados (lotes anteriores o el servicio en vivo)
+DEDUPE_DB_SQL = """
+DELETE FROM backfill_resolved d
+WHERE EXISTS (
+      SELECT 1 FROM audit_events e
+      WHERE d.object_id IS NOT NULL AND e.object_id = d.object_id
+        AND coalesce(e.username, '(unknown)') = coalesce(d.username, '(unknown)') AND e.ip = d.ip AND e.method = d.method
+        AND e.ts BETWEEN d.ts - %(dedupe)s * interval '1 second' AND d.ts + %(dedupe)s * interval '1 second')
+   OR EXISTS (
+      SELECT 1 FROM audit_events e
+      WHERE md5(e.resource) = md5(d.resource) AND e.resource = d.resource
+        AND coalesce(e.username, '(unknown)') = coalesce(d.username, '(unknown)') AND e.ip = d.ip AND e.method = d.method
+        AND e.ts BETWEEN d.ts - %(dedupe)s * interval '1 second' AND d.ts + %(dedupe)s * interval '1 second');
+"""
+
+INSERT_SQL = """
+INSERT INTO audit_events (%s)
+SELECT %s FROM backfill_resolved
+""" % (", ".join(STAGE_COLUMNS), ", ".join(STAGE_COLUMNS))
+
+def batch_duplicates(rows, window):
+    """
+    rids duplicados dentro del lote; rows = (rid, epoch, username, ip, method, resource, object_id) en orden de ts.
+    Mismas claves que DedupeCache (resource y object_id): cada evento se compara con el último conservado.
+    """
+    last = {}
+    dup = []
+    for rid, t, username, ip, method, resource, object_id in rows:
+        u = username or '(unknown)'
+        keys = [('r', resource, u, ip, method)]
+        if object_id:
+            keys.append(('o', object_id, u, ip, method))
+        if any(k in last and t - last[k] <= window for k in keys):
+            dup.append(rid)
+            continue
+        for k in keys:
+            last[k] = t
+    return dup
+
+def load_batch(conn, data):
+    """COPY + resolución + insert de un lote; devuelve las filas insertadas."""
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE backfill_stage;")
+        cur.copy_expert("COPY backfill_stage (%s) FROM STDIN" % ", ".join(STAGE_COLUMNS), io.StringIO(data))
+        cur.execute("ANALYZE backfill_stage;")
+        if la.audit_partitioned:
+            # meses archivados: sus particiones todavía no existen y todo iría a la DEFAULT
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('audit_events_schema'));")
+            cur.execute("SELECT min(ts), max(ts) FROM backfill_stage;")
+            first, last = cur.fetchone()
+            if first is not None:
+                la.ensure_partitions(cur, first, last)
+        for sql in RESOLVE_SQL:
+            cur.execute(sql)
+        cur.execute("TRUNCATE backfill_resolved;")
+        cur.execute(USERNAME_SQL, {"window": la.CORRELATION_WINDOW, "blacklist": sorted(la.HUMAN_BLACKLIST)})
+        cur.execute(DEDUPE_DB_SQL, {"dedupe": la.DEDUPE_SECONDS})
+        cur.execute("""
+            SELECT rid, extract(epoch from ts), username, ip, method, resource, object_id
+            FROM backfill_resolved ORDER BY ts, rid;
+        """)
+        dup = batch_duplicates(cur.fetchall(), la.DEDUPE_SECONDS)
+        if dup:
+            cur.execute("DELETE FROM backfill_resolved WHERE rid = ANY(%s);", (dup,))
+        cur.execute(INSERT_SQL + (" ON CONFLICT DO NOTHING" if la.dedupe_unique_active else ""))
+        inserted = cur.rowcount
+    conn.commit()
+    return inserted
+
+def run(files, workers=None, batch=BACKFILL_BATCH, chunk_lines=BACKFILL_CHUNK):
+    missing = [f for f in files if not os.path.exists(f)]
+    if missing:
+        print("backfill: files not found:", " ".join(missing))
+        return 1
+    workers = workers or os.cpu_count() or 1
+    la.ensure_table()
+    conn = la.db_connect()
+    with conn.cursor() as cur:
+        cur.execute(STAGE_SQL)
+    conn.commit()
+    t0 = time.monotonic()
+    lines = staged = inserted = 0
+    parts, part_events = [], 0
+
+    def flush():
+        nonlocal parts, part_events, staged, inserted
+        if not part_events:
+            return
+        inserted += load_batch(conn, ''.join(parts))
+        staged += part_events
+        parts, part_events = [], 0
+        elapsed = time.monotonic() - t0
+        print("backfill: %d lines read, %d events, %d inserted (%d duplicates), %.0f lines/s, %.0f events/s" % (
+            lines, staged, inserted, staged - inserted, lines / elapsed, staged / elapsed))
+
+    try:
+        with Pool(workers) as pool:
+            # a lo sumo 2 tareas por proceso en vuelo: Pool.imap leería los archivos enteros a memoria
+            inflight = deque()
+            chunks = read_chunks(files, chunk_lines)
+            while True:
+                for chunk in chunks:
+                    lines += len(chunk)
+                    inflight.append(pool.apply_async(parse_chunk, (chunk,)))
+                    if len(inflight) >= 2 * workers:
+                        break
+                if not inflight:
+                    break
+                n, data = inflight.popleft().get()
+                parts.append(data)
+                part_events += n
+                if part_events >= batch:
+                    flush()
+        flush()
+    finally:
+        conn.close()
+    elapsed = time.monotonic() - t0
+    print("backfill done: %d files, %d lines, %d events, %d inserted in %.1fs (%.0f lines/s)" % (
+        len(files), lines, staged, inserted, elapsed, lines / elapsed if elapsed else 0))
+    return 0
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+bench_app_parser.py - throughput de parse_nextcloud_app_line: el parser anterior (json.loads de
+cada línea + regex sobre message) vs. el actual (marcadores antes de decodificar, msgspec/orjson
+si están instalados, solo los campos necesarios).
+
+Por defecto genera un nextcloud.log sintético con la mezcla de un nivel debug (cron, apps,
+requests sin archivo) y ~3% de líneas con una URL de remote.php o un path en data;
+con --log se usa un nextcloud.log real.
+Uso: python bench_app_parser.py [--lines 1000000] [--interest 0.03] [--log /var/www/html/data/nextcloud.log]
+"""
+import argparse, json, random, re, time
+from datetime import datetime
+
+from dateutil import parser as dtparser
+
+import log_audit
+
+def legacy_parse(line):
+    # parse_nextcloud_app_line antes del prefiltro por marcadores
+    try:
+        j = json.loads(line)
+    except Exception:
+        return None
+    user = j.get("user") or j.get("uid") or j.get("user_id") or None
+    if j.get("time"):
+        try:
+            ts = dtparser.parse(j.get("time"))
+        except Exception:
+            ts = datetime.utcnow()
+    else:
+        ts = datetime.utcnow()
+    message = j.get("message","") or j.get("msg","")
+    resource = None
+    m = re.search(r'(/remote.php[^\s,\\"]+)', message)
+    if m:
+        resource = m.group(1)
+    data = j.get("data") or j.get("details") or {}
+    if isinstance(data, dict):
+        if not resource:
+            resource = data.get("path") or data.get("file") or data.get("resource")
+    if not resource:
+        return None
+    return {"ts": ts, "user": user, "resource": log_audit.normalize_resource(resource)}
+
+NOISE = [
+    ("cron", "Finished job OCA\\Files\\BackgroundJob\\ScanFiles (id: %d, arguments: null) after 0.01 seconds"),
+    ("core", "Checking for updated apps, run %d"),
+    ("dav", "Sabre\\DAV\\Exception\\NotAuthenticated: No public access to this resource., request %d"),
+    ("richdocuments", "Discovery cache refreshed (%d entries)"),
+    ("no app in context", "Memcache OC\\Memcache\\Redis hit %d"),
+]
+
+def synth(n, interest):
+    rnd = random.Random(42)
+    lines = []
+    for i in range(n):
+        entry = {"reqId": "r%08x" % rnd.getrandbits(32), "level": rnd.choice((0, 0, 1, 2)),
+                 "time": "2026-10-16T10:%02d:%02d+00:00" % (i // 60 % 60, i % 60), "remoteAddr": "10.0.%d.%d" % (i >> 8 & 255, i & 255),
+                 "user": "user%d" % (i % 40) if rnd.random() < 0.7 else "--", "method": rnd.choice(("GET", "PROPFIND", "POST")),
+                 "url": "/ocs/v2.php/apps/notifications/api/v2/notifications", "userAgent": "Mozilla/5.0 (X11; Linux x86_64)",
+                 "version": "28.0.4.1"}
+        if rnd.random() < interest:
+            if rnd.random() < 0.5:
+                entry["app"] = "webdav"
+                entry["message"] = "GET /remote.php/dav/files/user%d/Area/Proceso/DOC-%d.pdf served" % (i % 40, i)
+            else:
+                entry["app"] = "files"
+                entry["message"] = "File accessed"
+                entry["data"] = {"path": "/user%d/files/Area/DOC-%d.pdf" % (i % 40, i), "app": "files"}
+        else:
+            app, msg = rnd.choice(NOISE)
+            entry["app"] = app
+            entry["message"] = msg % i
+            if rnd.random() < 0.2:
+                entry["exception"] = {"Exception": "Exception", "Message": "trace %d" % i, "Code": 0,
+                                      "Trace": [{"file": "/var/www/html/lib/private/AppFramework/App.php", "line": 184}] * 8}
+        # como PHP json_encode: '/' escapado
+        lines.append(json.dumps(entry).replace("/", "\\/") + "\n")
+    return lines
+
+def run(parse, lines):
+    t0 = time.perf_counter()
+    parsed = sum(1 for line in lines if parse(line))
+    return time.perf_counter() - t0, parsed
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int, default=1000000)
+    ap.add_argument("--interest", type=float, default=0.03, help="fracción de líneas con recurso (sintético)")
+    ap.add_argument("--log", help="nextcloud.log real en vez del sintético")
+    args = ap.parse_args()
+
+    if args.log:
+        with open(args.log, encoding="utf-8", errors="ignore") as fh:
+            lines = fh.readlines()[:args.lines]
+    else:
+        lines = synth(args.lines, args.interest)
+    backend = "msgspec" if log_audit.msgspec else "orjson" if log_audit.orjson else "json"
+    base, base_parsed = run(legacy_parse, lines)
+    fast, fast_parsed = run(log_audit.parse_nextcloud_app_line, lines)
+    for label, elapsed, parsed in (("legacy", base, base_parsed), ("fast/" + backend, fast, fast_parsed)):
+        print("%-14s lines=%d parsed=%d %.2fs %.0f lines/s" % (label, len(lines), parsed, elapsed, len(lines) / elapsed))
+    if base_parsed != fast_parsed:
+        print("WARNING: parsed counts differ")
+    print("speedup: %.1fx" % (base / fast))
+
+if __name__ == "__main__":
+    main()
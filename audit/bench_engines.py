@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+bench_engines.py - throughput del pipeline de log_audit: motor con threads vs. motor asyncio.
+Cada motor recibe los mismos N eventos de descarga (fileId conocido, actividad en oc_activity)
+y se mide el tiempo hasta que todos quedan insertados en audit_events.
+
+Escribe en audit_events y crea oc_filecache/oc_activity sintéticas: usar una base de pruebas.
+Uso: python bench_engines.py --db audit_bench [--events 20000] > /dev/null   (el resumen sale por stderr)
+"""
+import argparse, asyncio, os, sys, time
+from datetime import datetime, timezone
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default="audit_bench", help="base de pruebas (se escribe en ella)")
+    ap.add_argument("--events", type=int, default=20000)
+    return ap.parse_args()
+
+args = parse_args()
+# las constantes de conexión se leen al importar log_audit
+os.environ["POSTGRES_DB"] = args.db
+
+import log_audit as la
+
+def setup(files):
+    with la.db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS oc_filecache, oc_activity;")
+            cur.execute("CREATE TABLE oc_filecache (fileid bigint PRIMARY KEY, storage int, path text, name text, mtime bigint);")
+            cur.execute("""
+                CREATE TABLE oc_activity (activity_id bigserial PRIMARY KEY, app text, "user" text, affecteduser text,
+                                          object_id bigint, file text, subjectparams text, timestamp bigint);
+            """)
+            cur.execute("""
+                INSERT INTO oc_filecache SELECT i, 1, 'files/Bench/doc_' || i || '.pdf', 'doc_' || i || '.pdf', 0
+                FROM generate_series(1, %s) AS i;
+            """, (files,))
+            cur.execute("""
+                INSERT INTO oc_activity (app, "user", affecteduser, object_id, file, subjectparams, timestamp)
+                SELECT 'files', 'user' || (i %% 50), 'user' || (i %% 50), i, '/Bench/doc_' || i || '.pdf', '[]',
+                       extract(epoch from now())::bigint
+                FROM generate_series(1, %s) AS i;
+            """, (files,))
+            cur.execute("CREATE INDEX ON oc_activity (object_id);")
+        conn.commit()
+
+def make_events(n):
+    now = datetime.now(timezone.utc)
+    return [{
+        "ts": now, "username": None, "ip": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), "method": "GET",
+        "resource": "/index.php/apps/files/download/%d" % (i + 1), "status": 200, "size": 1024,
+        "ua": "bench", "referrer": "", "raw": "",
+    } for i in range(n)]
+
+def reset():
+    la.dedupe = la.DedupeCache()
+    with la.db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE audit_events;")
+        conn.commit()
+
+def count_rows():
+    with la.db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM audit_events;")
+            return cur.fetchone()[0]
+
+def bench_threads(events):
+    la.writer.start()
+    la.resolver.start()
+    t0 = time.perf_counter()
+    for ev in events:
+        la.schedule_resolution_and_insert(ev)
+    while la.pending:
+        time.sleep(0.01)
+    la.writer.close()
+    return time.perf_counter() - t0
+
+async def bench_asyncio(events):
+    import async_engine
+    pool = await async_engine.asyncpg.create_pool(host=la.DB_HOST, database=la.DB_NAME, user=la.DB_USER,
+                                                  password=la.DB_PASS, min_size=la.DB_POOL_MIN, max_size=la.DB_POOL_MAX)
+    writer = async_engine.AsyncWriter(pool)
+    writer.start()
+    resolver = async_engine.AsyncResolver(pool, writer)
+    t0 = time.perf_counter()
+    for ev in events:
+        await resolver.submit(ev)
+    await resolver.idle()
+    await writer.close()
+    elapsed = time.perf_counter() - t0
+    await pool.close()
+    return elapsed
+
+def main():
+    la.ensure_table()
+    # un archivo por evento: claves canónicas distintas, nada se agrupa en pending
+    setup(args.events)
+    events = make_events(args.events)
+    results = []
+    for name, fn in (("threads", lambda evs: bench_threads(evs)), ("asyncio", lambda evs: asyncio.run(bench_asyncio(evs)))):
+        reset()
+        # los eventos se copian al entrar en pending; el mismo lote sirve para ambos motores
+        elapsed = fn(events)
+        rows = count_rows()
+        results.append((name, elapsed, rows))
+    # resumen por stderr: los motores imprimen una línea por evento en stdout
+    print("\n%-8s %10s %10s %12s" % ("engine", "seconds", "rows", "events/s"), file=sys.stderr)
+    for name, elapsed, rows in results:
+        print("%-8s %10.2f %10d %12.0f" % (name, elapsed, rows, len(events) / elapsed), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+bench_filename_lookup.py - compara el fallback por filename de find_fileid_and_path:
+ILIKE '%fname%' (scan) vs. el mismo lookup con índice GIN pg_trgm (FILENAME_LOOKUP=trgm),
+sobre una tabla sintética con la forma de oc_filecache (por defecto 1M filas).
+
+Uso: python bench_filename_lookup.py [--rows 1000000] [--queries 50] [--keep]
+Usa las mismas variables de conexión que log_audit.py (DB_HOST, POSTGRES_DB, ...).
+"""
+import argparse, hashlib, random, statistics, time
+
+import log_audit
+
+TABLE = "audit_bench_filecache"
+
+def fname_for(i):
+    return "DOC-%d_%s.pdf" % (i, hashlib.md5(str(i).encode()).hexdigest()[:8])
+
+def build(cur, rows):
+    cur.execute("DROP TABLE IF EXISTS %s;" % TABLE)
+    cur.execute("CREATE UNLOGGED TABLE %s (fileid bigint PRIMARY KEY, path text NOT NULL);" % TABLE)
+    cur.execute("""
+        INSERT INTO %s (fileid, path)
+        SELECT i, 'files/Area_' || (i %% 40) || '/Proceso_' || (i %% 997) || '/DOC-' || i || '_' || substr(md5(i::text), 1, 8) || '.pdf'
+        FROM generate_series(1, %%s) AS i;
+    """ % TABLE, (rows,))
+    cur.execute("ANALYZE %s;" % TABLE)
+
+def run(cur, sql, names):
+    times = []
+    found = 0
+    for n in names:
+        t0 = time.perf_counter()
+        cur.execute(sql, ('%' + n + '%',))
+        if cur.fetchone():
+            found += 1
+        times.append(time.perf_counter() - t0)
+    return times, found
+
+def report(label, times, found):
+    print("%-6s queries=%d found=%d mean=%.2fms p50=%.2fms max=%.2fms qps=%.1f" % (
+        label, len(times), found, statistics.mean(times) * 1000, statistics.median(times) * 1000,
+        max(times) * 1000, len(times) / sum(times)))
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=1000000)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--keep", action="store_true", help="no borrar la tabla sintética al terminar")
+    args = ap.parse_args()
+
+    conn = log_audit.db_connect()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            t0 = time.perf_counter()
+            build(cur, args.rows)
+            print("built %s with %d rows in %.1fs" % (TABLE, args.rows, time.perf_counter() - t0))
+            rnd = random.Random(42)
+            names = [fname_for(rnd.randint(1, args.rows)) for _ in range(args.queries)]
+
+            ilike_sql = log_audit.FNAME_ILIKE_SQL.replace("oc_filecache", TABLE)
+            trgm_sql = log_audit.FNAME_TRGM_SQL.replace("oc_filecache", TABLE)
+
+            ilike = run(cur, ilike_sql, names)
+            report("ilike", *ilike)
+
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            t0 = time.perf_counter()
+            cur.execute("CREATE INDEX %s_path_trgm ON %s USING gin (path gin_trgm_ops);" % (TABLE, TABLE))
+            cur.execute("ANALYZE %s;" % TABLE)
+            print("built pg_trgm GIN index in %.1fs" % (time.perf_counter() - t0))
+
+            trgm = run(cur, trgm_sql, names)
+            report("trgm", *trgm)
+            print("speedup (mean): %.1fx" % (statistics.mean(ilike[0]) / statistics.mean(trgm[0])))
+            if not args.keep:
+                cur.execute("DROP TABLE IF EXISTS %s;" % TABLE)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+bench_prefilter.py - throughput de parse_apache_line con y sin APACHE_PREFILTER_RE.
+Sin prefiltro cada línea pasa por APACHE_RE completo y recién después por INTEREST_PATTERNS;
+con prefiltro las líneas sin método + patrón de interés se descartan en una sola búsqueda.
+
+Se informa el total y, aparte, solo las líneas descartadas (las que el prefiltro evita parsear);
+en las de interés domina el parseo de la fecha, igual en ambos casos.
+Por defecto genera un access.log sintético de 1M líneas (estáticos, polling de ocs/status,
+dashboards y ~8% de accesos a archivos); con --log se usa un access.log real.
+Uso: python bench_prefilter.py [--lines 1000000] [--interest 0.08] [--log /var/log/apache2/access.log]
+"""
+import argparse, random, time
+
+import log_audit
+
+STATIC = [
+    "/core/css/server.css?v=%x", "/apps/files/js/main.js?v=%x", "/core/img/logo/logo.svg?v=%x",
+    "/ocs/v2.php/apps/notifications/api/v2/notifications?format=json&t=%d",
+    "/ocs/v2.php/apps/user_status/api/v1/heartbeat?format=json&t=%d",
+    "/status.php?t=%d", "/index.php/apps/dashboard/?t=%d", "/index.php/csrftoken?t=%d",
+    "/index.php/apps/files/?dir=/Area_%d",
+]
+INTEREST = [
+    "/remote.php/dav/files/user%d/Area/Proceso/DOC-%d.pdf", "/index.php/apps/files/download/%d?x=%d",
+    "/index.php/apps/richdocuments/index?fileId=%d&t=%d", "/index.php/s/Ab%dCd%d/download",
+]
+UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+
+def synth(n, interest):
+    rnd = random.Random(42)
+    lines = []
+    for i in range(n):
+        if rnd.random() < interest:
+            url = rnd.choice(INTEREST) % (i % 50, i)
+            method = rnd.choice(("GET", "GET", "PROPFIND", "PUT"))
+        else:
+            url = rnd.choice(STATIC) % i
+            method = rnd.choice(("GET", "GET", "GET", "POST", "PROPFIND"))
+        lines.append('10.%d.%d.%d - - [16/Oct/2026:10:%02d:%02d +0000] "%s %s HTTP/1.1" %d %d "https://cloud.example.com/index.php/apps/files/" "%s"\n' % (
+            i >> 16 & 255, i >> 8 & 255, i & 255, i // 60 % 60, i % 60, method, url,
+            rnd.choice((200, 200, 200, 207, 304)), rnd.randint(100, 99999), UA))
+    return lines
+
+class _NoPrefilter:
+    # comportamiento anterior: toda línea llega a APACHE_RE
+    @staticmethod
+    def search(line):
+        return True
+
+def run(lines):
+    t0 = time.perf_counter()
+    parsed = sum(1 for line in lines if log_audit.parse_apache_line(line))
+    return time.perf_counter() - t0, parsed
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int, default=1000000)
+    ap.add_argument("--interest", type=float, default=0.08, help="fracción de líneas de acceso a archivos (sintético)")
+    ap.add_argument("--log", help="access.log real en vez del sintético")
+    args = ap.parse_args()
+
+    if args.log:
+        with open(args.log, encoding="utf-8", errors="ignore") as fh:
+            lines = fh.readlines()[:args.lines]
+    else:
+        lines = synth(args.lines, args.interest)
+    discarded = [line for line in lines if not log_audit.parse_apache_line(line)]
+    prefilter = log_audit.APACHE_PREFILTER_RE
+    results = []
+    for label, pf in (("full-re", _NoPrefilter), ("prefilter", prefilter)):
+        log_audit.APACHE_PREFILTER_RE = pf
+        results.append((label, run(lines), run(discarded)))
+    log_audit.APACHE_PREFILTER_RE = prefilter
+    for label, (elapsed, parsed), (d_elapsed, _) in results:
+        print("%-10s lines=%d parsed=%d %.2fs %.0f lines/s | discarded=%d %.0f lines/s" % (
+            label, len(lines), parsed, elapsed, len(lines) / elapsed, len(discarded), len(discarded) / d_elapsed))
+    (_, (base, base_parsed), (d_base, _)), (_, (fast, fast_parsed), (d_fast, _)) = results
+    if base_parsed != fast_parsed:
+        print("WARNING: prefilter changed the parsed count")
+    print("speedup: %.1fx total, %.1fx on discarded lines" % (base / fast, d_base / d_fast))
+
+if __name__ == "__main__":
+    main()
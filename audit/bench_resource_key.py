@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+bench_resource_key.py - costo por línea de la canonicalización de recursos (normalize_resource +
+canonical_key_for_resource + detect_event_type, lo que paga cada línea de interés del access log):
+implementación anterior (import de urllib por llamada, tres re.search sin compilar) vs. resource_key.
+
+Las URLs sintéticas repiten archivos como en un access log real (--distinct URLs distintas sobre
+--lines líneas); con --distinct igual a --lines se mide el caso sin aciertos en el memo.
+Uso: python bench_resource_key.py [--lines 1000000] [--distinct 20000]
+"""
+import argparse, random, re, time
+
+import resource_key
+
+def legacy_normalize_resource(r):
+    if not r:
+        return r
+    r2 = r.split('?',1)[0]
+    try:
+        from urllib.parse import unquote
+        r2 = unquote(r2)
+    except Exception:
+        pass
+    return r2.rstrip('/')
+
+def legacy_detect_event_type(method, status, resource):
+    try:
+        from urllib.parse import urlparse, parse_qs
+        up = urlparse(resource)
+        qs = parse_qs(up.query or "")
+        path = up.path or resource
+    except Exception:
+        path = resource; qs = {}
+    m = method.upper()
+    if 'download' in (path or "").lower() or 'download' in (",".join(qs.keys()).lower()):
+        return "download"
+    if m == "PROPFIND":
+        return "list"
+    if m == "GET" and status == 200 and resource_key.FILE_EXT_RE.search(path or ""):
+        return "download"
+    if m == "GET" and status == 200:
+        return "view"
+    return "other"
+
+def legacy_canonical_key_for_resource(resource):
+    res = legacy_normalize_resource(resource or '')
+    m = re.search(r'fileId=(\d+)', res)
+    if not m:
+        m = re.search(r'/download/(\d+)', res)
+    if not m:
+        m = re.search(r'/wopi/files/(\d+)_', res)
+    if m:
+        try:
+            fid = int(m.group(1))
+            return ("fileid:%d" % fid, fid)
+        except:
+            pass
+    return ("resource:%s" % res, None)
+
+URLS = [
+    "/remote.php/dav/files/user%d/%%C3%%81rea%%20Calidad/Proceso/DOC-%d.pdf",
+    "/index.php/apps/files/download/%d?x=%d",
+    "/index.php/apps/richdocuments/wopi/files/%d_ocabc123/contents?access_token=%d",
+    "/index.php/apps/files_pdfviewer/?file=/Area/DOC-%d.pdf&v=%d",
+    "/index.php/s/Ab%dCd%d/download",
+]
+
+def synth(lines, distinct):
+    rnd = random.Random(42)
+    pool = [rnd.choice(URLS) % (i, i) for i in range(distinct)]
+    return [(rnd.choice(("GET", "GET", "PUT", "PROPFIND")), rnd.choice((200, 200, 207, 304)), rnd.choice(pool))
+            for _ in range(lines)]
+
+def run(normalize, canonical, detect, events):
+    t0 = time.perf_counter()
+    out = []
+    for method, status, url in events:
+        res = normalize(url)
+        out.append((canonical(res), detect(method, status, res or '')))
+    return time.perf_counter() - t0, out
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--lines", type=int, default=1000000)
+    ap.add_argument("--distinct", type=int, default=20000)
+    args = ap.parse_args()
+
+    events = synth(args.lines, args.distinct)
+    base, base_out = run(legacy_normalize_resource, legacy_canonical_key_for_resource, legacy_detect_event_type, events)
+    fast, fast_out = run(resource_key.normalize_resource, resource_key.canonical_key_for_resource,
+                         resource_key.detect_event_type, events)
+    for label, elapsed in (("legacy", base), ("resource_key", fast)):
+        print("%-13s lines=%d %.2fs %.2f us/line" % (label, len(events), elapsed, elapsed / len(events) * 1e6))
+    if base_out != fast_out:
+        print("WARNING: results differ")
+    info = resource_key.canonical_key_for_resource.cache_info()
+    print("speedup: %.1fx (canonical memo hits=%d misses=%d)" % (base / fast, info.hits, info.misses))
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,20 @@ log_audit.py - audit improved
 Guarda original_resource (URL) y resource (ruta humana resuelta desde oc_filecache) + object_id.
 Mantiene dedupe por object_id y lógica de resolución de username (RESOLVE_WAIT).
 """
-import os, re, time, json, traceback, threading
-from datetime import datetime, timedelta
+import os, re, sys, time, json, random, traceback, threading, heapq, queue, signal, atexit, argparse
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+if __name__ == "__main__":
+    # async_engine y backfill hacen `import log_audit`: que reciban este módulo y no una segunda copia
+    # (con su propio scan_since, pools y caches) ejecutada de nuevo desde el archivo
+    sys.modules.setdefault("log_audit", sys.modules[__name__])
 
 try:
     import psycopg2
+    from psycopg2 import pool as pgpool
+    from psycopg2.extras import execute_values
 except Exception as e:
     print("Missing psycopg2:", e); raise
 
@@ -20,6 +29,21 @@ except Exception:
 
 from dateutil import parser as dtparser
 
+# decoders JSON opcionales para nextcloud.log (se usa el primero disponible; si no, json)
+try:
+    import msgspec
+except Exception:
+    msgspec = None
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+from log_ingest import LogTailer, Checkpoints, mark_done, tail_lines, lines_since
+import metrics
+import tracing
+from resource_key import normalize_resource, canonical_key_for_resource, detect_event_type
+
 # --- ENV / config ---
 def getenv_any(*names, default=None):
     for n in names:
@@ -36,15 +60,81 @@ DB_PASS = getenv_any("POSTGRES_PASSWORD","DB_PASS","POSTGRES_PASSWORD", default=
 ACCESS_LOG = os.getenv("NEXTCLOUD_LOG_PATH", "/var/log/apache2/access.log")
 NEXTCLOUD_APP_LOG = os.getenv("NEXTCLOUD_APP_LOG", "/var/www/html/data/nextcloud/nextcloud.log")
 
+# "auto" (inotify + polling lento de respaldo) | "inotify" | "poll" (bind mounts sin inotify)
+TAIL_MODE = os.getenv("TAIL_MODE","auto").lower()
+TAIL_POLL_INTERVAL = float(os.getenv("TAIL_POLL_INTERVAL","0.5"))
+TAIL_POLL_FALLBACK = float(os.getenv("TAIL_POLL_FALLBACK","5"))
+# checkpoint por log (inode, offset, hash de la última línea) para retomar tras un reinicio; "" lo desactiva
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE","/var/lib/audit/checkpoints.json")
+# endpoint de métricas Prometheus (GET /metrics); 0 lo desactiva
+METRICS_PORT = int(os.getenv("METRICS_PORT","9108"))
+METRICS_ADDR = os.getenv("METRICS_ADDR","127.0.0.1")
+
 DEDUPE_SECONDS = int(os.getenv("DEDUPE_SECONDS","2"))
 CORRELATION_WINDOW = int(os.getenv("CORRELATION_WINDOW","30"))
+# al arrancar se cargan en el índice de dedupe los eventos de los últimos N segundos
+DEDUPE_SEED_SECONDS = int(os.getenv("DEDUPE_SEED_SECONDS","60"))
+# 1 = consultar también audit_events ante cada miss (varias instancias escribiendo la misma tabla)
+DEDUPE_DB_FALLBACK = os.getenv("DEDUPE_DB_FALLBACK","0") == "1"
+# 1 = columna dedupe_bucket + índices únicos; el insert pasa a ON CONFLICT DO NOTHING
+AUDIT_DEDUPE_UNIQUE = os.getenv("AUDIT_DEDUPE_UNIQUE","0") == "1"
+
+# particionado por rango mensual de ts: "none" | "monthly"
+AUDIT_PARTITIONING = os.getenv("AUDIT_PARTITIONING","none").lower()
+# 1 = convertir una audit_events existente (no particionada) adjuntándola como partición legacy
+AUDIT_PARTITION_MIGRATE = os.getenv("AUDIT_PARTITION_MIGRATE","0") == "1"
+AUDIT_PARTITIONS_AHEAD = int(os.getenv("AUDIT_PARTITIONS_AHEAD","2"))
+AUDIT_PARTITION_CHECK_INTERVAL = int(os.getenv("AUDIT_PARTITION_CHECK_INTERVAL","3600"))
+# 0 = sin retención; N = particiones que terminan antes de (mes actual - N) se detach/drop
+AUDIT_RETENTION_MONTHS = int(os.getenv("AUDIT_RETENTION_MONTHS","0"))
+AUDIT_RETENTION_ACTION = os.getenv("AUDIT_RETENTION_ACTION","detach").lower()
 
 RESOLVE_WAIT = int(os.getenv("RESOLVE_WAIT","10"))
-RESOLVE_INTERVAL = int(os.getenv("RESOLVE_INTERVAL","1"))
+# primer reintento; los siguientes crecen x RESOLVE_BACKOFF_FACTOR hasta RESOLVE_BACKOFF_MAX (1 = intervalo fijo)
+RESOLVE_INTERVAL = float(os.getenv("RESOLVE_INTERVAL","1"))
+RESOLVE_BACKOFF_FACTOR = float(os.getenv("RESOLVE_BACKOFF_FACTOR","2"))
+RESOLVE_BACKOFF_MAX = float(os.getenv("RESOLVE_BACKOFF_MAX","4"))
+# fracción de jitter sobre cada espera (+-), para no sincronizar los reintentos de una ráfaga
+RESOLVE_JITTER = float(os.getenv("RESOLVE_JITTER","0.2"))
+# "threads" (watchdog + workers) | "asyncio" (async_engine.py, asyncpg)
+AUDIT_ENGINE = os.getenv("AUDIT_ENGINE","threads").lower()
+RESOLVE_WORKERS = int(os.getenv("RESOLVE_WORKERS","8"))
+
+PATH_CACHE_SIZE = int(os.getenv("PATH_CACHE_SIZE","10000"))
+PATH_CACHE_TTL = float(os.getenv("PATH_CACHE_TTL","300"))
+PATH_CACHE_NEG_TTL = float(os.getenv("PATH_CACHE_NEG_TTL","5"))
+# fallback por nombre de archivo: "ilike" (scan de oc_filecache) | "trgm" (índice GIN pg_trgm, opt-in)
+FILENAME_LOOKUP = os.getenv("FILENAME_LOOKUP","ilike").lower()
+
+# espejo en memoria de oc_filecache (fileid/path/nombre) en vez de consultar por evento
+FILECACHE_MIRROR = os.getenv("FILECACHE_MIRROR","0") == "1"
+# storage ids a espejar, separados por coma (vacío = todas)
+FILECACHE_STORAGES = [int(x) for x in os.getenv("FILECACHE_STORAGES","").split(",") if x.strip()]
+FILECACHE_MIRROR_INTERVAL = float(os.getenv("FILECACHE_MIRROR_INTERVAL","5"))
+# reconstrucción completa periódica (borrados y movimientos que no cambian mtime)
+FILECACHE_MIRROR_REBUILD = int(os.getenv("FILECACHE_MIRROR_REBUILD","3600"))
+# si oc_filecache supera este tamaño el espejo se desactiva y se vuelve a las consultas
+FILECACHE_MIRROR_MAX = int(os.getenv("FILECACHE_MIRROR_MAX","2000000"))
+MAX_PENDING = int(os.getenv("MAX_PENDING","5000"))
+# atribución desde una cola en memoria de oc_activity (watermark de activity_id)
+ACTIVITY_FEED = os.getenv("ACTIVITY_FEED","0") == "1"
+ACTIVITY_FEED_INTERVAL = float(os.getenv("ACTIVITY_FEED_INTERVAL","1"))
+ACTIVITY_FEED_SEED = int(os.getenv("ACTIVITY_FEED_SEED","86400"))
+ACTIVITY_FEED_MAX_OBJECTS = int(os.getenv("ACTIVITY_FEED_MAX_OBJECTS","100000"))
+# máximo de claves que un worker resuelve juntas por tick
+RESOLVE_BATCH = int(os.getenv("RESOLVE_BATCH","200"))
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN","1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX","10"))
+# conexiones ociosas más de N segundos se verifican con SELECT 1 antes de prestarlas
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE","30"))
+
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE","500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL","1"))
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX","20000"))
 
 # regex
 APACHE_RE = re.compile(r'(?P<ip>\S+) \S+ (?P<user>\S+) \[(?P<time>[^\]]+)\] "(?P<method>GET|POST|PUT|DELETE|PROPFIND) (?P<url>\S+)[^"]*" (?P<status>\d{3}) (?P<size>\S+) "(?P<referrer>[^"]*)" "(?P<ua>[^"]*)"')
-FILE_EXT_RE = re.compile(r'\.(pdf|docx?|xlsx?|pptx?|txt|odt|ods|jpg|jpeg|png|zip|rar|7z)(?:$|\?)', re.IGNORECASE)
 
 INTEREST_PATTERNS = [
     "/remote.php/dav/files/",
@@ -54,6 +144,9 @@ INTEREST_PATTERNS = [
     "/index.php/s/",
     "/index.php/apps/richdocuments",
 ]
+# prefiltro antes de APACHE_RE: una sola pasada que exige método + algún INTEREST_PATTERN dentro de la URL.
+# Acepta un superconjunto de lo que pasa APACHE_RE + el chequeo de INTEREST_PATTERNS ([^ ]* cubre el \S+ de la URL)
+APACHE_PREFILTER_RE = re.compile(r'"(?:GET|POST|PUT|DELETE|PROPFIND) [^ ]*(?:%s)' % "|".join(re.escape(p) for p in INTEREST_PATTERNS))
 
 IGNORE_PATTERNS = [
     "/index.php/apps/richdocuments/wopi/settings",
@@ -64,10 +157,124 @@ IGNORE_PATTERNS = [
 def db_connect():
     return psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS, connect_timeout=5)
 
-def ensure_table():
-    sql_create = """
-    CREATE TABLE IF NOT EXISTS audit_events (
-        id SERIAL PRIMARY KEY,
+class DBPool:
+    """
+    Pool compartido (ThreadedConnectionPool) con espera acotada por semáforo:
+    si no hay conexiones libres el thread espera en vez de recibir PoolError.
+    Las conexiones cerradas o que fallan el health check se descartan y se reabren.
+    """
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(self.maxconn)
+        self._last_used = {}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = pgpool.ThreadedConnectionPool(self.minconn, self.maxconn, host=DB_HOST, dbname=DB_NAME,
+                                                           user=DB_USER, password=DB_PASS, connect_timeout=5)
+            return self._pool
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < DB_POOL_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        p = self._get_pool()
+        for _ in range(self.maxconn + 1):
+            conn = p.getconn()
+            if self._healthy(conn):
+                return conn
+            self._discard(conn)
+        raise psycopg2.OperationalError("DBPool: no healthy connection available")
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            self._get_pool().putconn(conn, close=True)
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Igual que `with db_connect() as conn`: commit al salir, rollback si hay excepción."""
+        self._sem.acquire()
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self._discard(conn)
+                raise
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    self._discard(conn)
+                    raise
+                self._release(conn)
+                raise
+            else:
+                self._release(conn)
+        finally:
+            self._sem.release()
+
+    def _release(self, conn):
+        if conn.closed:
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._get_pool().putconn(conn)
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._last_used.clear()
+
+db_pool = DBPool()
+
+def db_conn():
+    return db_pool.connection()
+
+# schema de audit_events versionado: cada migración se aplica una vez (audit_schema_migrations)
+# y todos sus pasos son idempotentes, así que también es seguro re-ejecutarlos sobre tablas existentes
+def _migration_dedupe_bucket(cur):
+    # columna bucket generada + índices únicos parciales para INSERT ... ON CONFLICT DO NOTHING.
+    # Solo cubren filas nuevas (id > max actual) para no fallar con duplicados ya existentes.
+    width = max(1, DEDUPE_SECONDS)
+    cur.execute("""
+        ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS dedupe_bucket bigint
+        GENERATED ALWAYS AS (floor(extract(epoch from (ts AT TIME ZONE 'UTC')) / %d)::bigint) STORED;
+    """ % width)
+    cur.execute("SELECT coalesce(max(id), 0) FROM audit_events;")
+    max_id = int(cur.fetchone()[0])
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS audit_events_dedupe_object_uq ON audit_events
+        (object_id, coalesce(username,'(unknown)'), coalesce(ip,''), method, dedupe_bucket)
+        WHERE object_id IS NOT NULL AND id > %d;
+    """ % max_id)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS audit_events_dedupe_resource_uq ON audit_events
+        (md5(coalesce(resource,'')), coalesce(username,'(unknown)'), coalesce(ip,''), method, dedupe_bucket)
+        WHERE id > %d;
+    """ % max_id)
+
+AUDIT_COLUMNS_SQL = """
         ts timestamptz NOT NULL,
         username text,
         ip text,
@@ -81,316 +288,1422 @@ def ensure_table():
         referrer text,
         raw_line text,
         event_type text
+"""
+
+SCHEMA_MIGRATIONS = [
+    ("001_compat_columns", [
+        # garantizar columnas por compatibilidad
+        "ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS original_resource text;",
+        "ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS resource text;",
+        "ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS object_id bigint;",
+    ]),
+    ("002_lookup_indexes", [
+        "CREATE INDEX IF NOT EXISTS audit_events_object_id_ts_idx ON audit_events (object_id, ts);",
+        # md5: una entrada btree no admite más de ~2.7 KB y resource viene de la URL
+        "CREATE INDEX IF NOT EXISTS audit_events_resource_md5_ts_idx ON audit_events (md5(resource), ts);",
+        "CREATE INDEX IF NOT EXISTS audit_events_username_ts_idx ON audit_events (username, ts);",
+    ]),
+    # opcional (AUDIT_DEDUPE_UNIQUE=1)
+    ("003_dedupe_bucket", [_migration_dedupe_bucket]),
+    # bases creadas con el índice btree sobre resource crudo (rechaza resources largos)
+    ("004_resource_md5_index", [
+        "CREATE INDEX IF NOT EXISTS audit_events_resource_md5_ts_idx ON audit_events (md5(resource), ts);",
+        "DROP INDEX IF EXISTS audit_events_resource_ts_idx;",
+    ]),
+]
+# los índices únicos sobre una tabla particionada tendrían que incluir ts: no aplica en modo monthly
+OPTIONAL_MIGRATIONS = {"003_dedupe_bucket": AUDIT_DEDUPE_UNIQUE and AUDIT_PARTITIONING != "monthly"}
+
+# True si la tabla tiene los índices únicos de dedupe -> el writer usa ON CONFLICT DO NOTHING
+dedupe_unique_active = False
+audit_partitioned = False
+
+def _table_kind(cur, name):
+    cur.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s);", (name,))
+    r = cur.fetchone()
+    return r[0] if r else None
+
+def _create_partitioned_table(cur):
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS audit_events_id_seq;")
+    cur.execute("""
+    CREATE TABLE audit_events (
+        id int NOT NULL DEFAULT nextval('audit_events_id_seq'),
+    """ + AUDIT_COLUMNS_SQL + """,
+        PRIMARY KEY (id, ts)
+    ) PARTITION BY RANGE (ts);
+    """)
+    cur.execute("ALTER SEQUENCE audit_events_id_seq OWNED BY audit_events.id;")
+    # red de seguridad si el mantenimiento de particiones se atrasa
+    cur.execute("CREATE TABLE IF NOT EXISTS audit_events_default PARTITION OF audit_events DEFAULT;")
+
+def _migrate_to_partitioned(cur):
+    """
+    audit_events existente -> audit_events_legacy, adjuntada sin copiar datos como partición
+    FROM (MINVALUE) TO (inicio del mes siguiente al último ts). ATTACH valida la tabla una vez.
+    """
+    cur.execute("SELECT greatest(date_trunc('month', max(ts) AT TIME ZONE 'UTC'), date_trunc('month', now() AT TIME ZONE 'UTC')) + interval '1 month' FROM audit_events;")
+    boundary = cur.fetchone()[0]
+    cur.execute("ALTER TABLE audit_events RENAME TO audit_events_legacy;")
+    cur.execute("ALTER INDEX IF EXISTS audit_events_pkey RENAME TO audit_events_legacy_pkey;")
+    cur.execute("DROP INDEX IF EXISTS audit_events_resource_ts_idx;")
+    for idx in ("audit_events_object_id_ts_idx", "audit_events_resource_md5_ts_idx", "audit_events_username_ts_idx"):
+        cur.execute("ALTER INDEX IF EXISTS %s RENAME TO %s;" % (idx, idx.replace("audit_events_", "audit_events_legacy_", 1)))
+    # dedupe_bucket (003) no existe en el padre particionado y ATTACH exige las mismas columnas
+    cur.execute("ALTER TABLE audit_events_legacy DROP COLUMN IF EXISTS dedupe_bucket CASCADE;")
+    cur.execute("DELETE FROM audit_schema_migrations WHERE name = '003_dedupe_bucket';")
+    cur.execute("ALTER SEQUENCE IF EXISTS audit_events_id_seq OWNED BY NONE;")
+    _create_partitioned_table(cur)
+    for step in dict(SCHEMA_MIGRATIONS)["002_lookup_indexes"]:
+        cur.execute(step)
+    cur.execute("ALTER TABLE audit_events ATTACH PARTITION audit_events_legacy FOR VALUES FROM (MINVALUE) TO (%s);",
+                (boundary.strftime('%Y-%m-%d 00:00:00+00'),))
+    print("audit_events migrated to monthly partitions; legacy rows kept in audit_events_legacy (< %s)" % boundary.date())
+
+def _month_start(d, add=0):
+    m = d.month - 1 + add
+    return datetime(d.year + m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+
+_BOUND_RE = re.compile(r"FROM \((MINVALUE|'[^']+')\) TO \((MAXVALUE|'[^']+')\)")
+
+def _list_partitions(cur):
+    # [(nombre, desde|None, hasta|None)] de las particiones por rango (sin la DEFAULT)
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'audit_events'::regclass;
+    """)
+    parts = []
+    for name, bound in cur.fetchall():
+        m = _BOUND_RE.search(bound or '')
+        if not m:
+            continue
+        lo, hi = [None if v.endswith('VALUE') else dtparser.parse(v.strip("'")) for v in m.groups()]
+        parts.append((name, lo, hi))
+    return parts
+
+def _utc(d):
+    return d.astimezone(timezone.utc) if d.tzinfo is not None else d.replace(tzinfo=timezone.utc)
+
+def ensure_partitions(cur, first, last):
+    """
+    Crea las particiones mensuales que falten desde el mes de `first` hasta el de `last` (inclusive).
+    Un mes que ya tiene filas en la DEFAULT no se puede particionar (PostgreSQL rechaza el CREATE):
+    se avisa y esas filas siguen en la DEFAULT. Devuelve las particiones por rango.
+    """
+    parts = _list_partitions(cur)
+    first, last = _utc(first), _utc(last)
+    i = 0
+    while _month_start(first, i) <= last:
+        lo, hi = _month_start(first, i), _month_start(first, i + 1)
+        i += 1
+        # saltar meses ya cubiertos (p.ej. por la partición legacy)
+        if any((plo is None or plo < hi) and (phi is None or phi > lo) for _, plo, phi in parts):
+            continue
+        name = "audit_events_p%04d%02d" % (lo.year, lo.month)
+        cur.execute("SAVEPOINT audit_partition;")
+        try:
+            cur.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF audit_events FOR VALUES FROM (%%s) TO (%%s);" % name,
+                        (lo.isoformat(), hi.isoformat()))
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT audit_partition;")
+            print("audit partition %s not created:" % name, str(e).strip())
+            continue
+        finally:
+            cur.execute("RELEASE SAVEPOINT audit_partition;")
+        parts.append((name, lo, hi))
+        print("audit partition created:", name)
+    return parts
+
+def maintain_partitions(cur):
+    """Crea las particiones del mes actual + AUDIT_PARTITIONS_AHEAD y aplica la retención."""
+    now = datetime.now(timezone.utc)
+    parts = ensure_partitions(cur, now, _month_start(now, AUDIT_PARTITIONS_AHEAD))
+    if AUDIT_RETENTION_MONTHS > 0:
+        cutoff = _month_start(now, -AUDIT_RETENTION_MONTHS)
+        for name, lo, hi in parts:
+            if hi is None or hi > cutoff:
+                continue
+            if AUDIT_RETENTION_ACTION == "drop":
+                cur.execute("DROP TABLE IF EXISTS %s;" % name)
+            else:
+                cur.execute("ALTER TABLE audit_events DETACH PARTITION %s;" % name)
+            print("audit partition %s (retention):" % AUDIT_RETENTION_ACTION, name)
+
+def partition_maintenance_loop():
+    while True:
+        time.sleep(AUDIT_PARTITION_CHECK_INTERVAL)
+        try:
+            with db_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext('audit_events_schema'));")
+                    maintain_partitions(cur)
+                conn.commit()
+        except Exception as e:
+            print("partition maintenance error:", e)
+
+def ensure_table():
+    global dedupe_unique_active, audit_partitioned
+    sql_create = """
+    CREATE TABLE IF NOT EXISTS audit_events (
+        id SERIAL PRIMARY KEY,
+    """ + AUDIT_COLUMNS_SQL + """
     );
     """
     try:
-        with db_connect() as conn:
+        with db_conn() as conn:
             with conn.cursor() as cur:
+                # serializar migraciones si arrancan varias instancias a la vez
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('audit_events_schema'));")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS audit_schema_migrations (
+                        name text PRIMARY KEY,
+                        applied_at timestamptz NOT NULL DEFAULT now()
+                    );
+                """)
+                if AUDIT_PARTITIONING == "monthly":
+                    kind = _table_kind(cur, "audit_events")
+                    if kind is None:
+                        _create_partitioned_table(cur)
+                    elif kind == 'r':
+                        if AUDIT_PARTITION_MIGRATE:
+                            _migrate_to_partitioned(cur)
+                        else:
+                            print("audit_events is not partitioned; set AUDIT_PARTITION_MIGRATE=1 to convert it")
                 cur.execute(sql_create)
-                # garantizar columnas por compatibilidad
-                cur.execute("ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS original_resource text;")
-                cur.execute("ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS resource text;")
-                cur.execute("ALTER TABLE audit_events ADD COLUMN IF NOT EXISTS object_id bigint;")
+                cur.execute("SELECT name FROM audit_schema_migrations;")
+                applied = set(r[0] for r in cur.fetchall())
+                for name, steps in SCHEMA_MIGRATIONS:
+                    if name in applied or not OPTIONAL_MIGRATIONS.get(name, True):
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            step(cur)
+                        else:
+                            cur.execute(step)
+                    cur.execute("INSERT INTO audit_schema_migrations (name) VALUES (%s) ON CONFLICT DO NOTHING;", (name,))
+                    applied.add(name)
+                    print("audit schema migration applied:", name)
+                audit_partitioned = _table_kind(cur, "audit_events") == 'p'
+                if audit_partitioned:
+                    maintain_partitions(cur)
                 conn.commit()
+            dedupe_unique_active = "003_dedupe_bucket" in applied
     except Exception as e:
         print("ensure_table DB error:", e)
         raise
 
+class TTLCache:
+    """LRU acotado (OrderedDict) con expiración por entrada y contadores de hits/misses."""
+    MISS = object()
+
+    def __init__(self, maxsize, ttl, neg_ttl=None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.neg_ttl = ttl if neg_ttl is None else neg_ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return self.MISS
+
+    def put(self, key, value, negative=False):
+        ttl = self.neg_ttl if negative else self.ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+# path normalizado -> (fileid, path); también cachea "no encontrado" (PATH_CACHE_NEG_TTL)
+path_cache = TTLCache(PATH_CACHE_SIZE, PATH_CACHE_TTL, PATH_CACHE_NEG_TTL)
+
+TRGM_INDEX = "audit_oc_filecache_path_trgm"
+# modo efectivo: pasa a "trgm" solo cuando la extensión y el índice están listos
+filename_lookup_mode = "ilike"
+
+FILEID_BY_PATH_SQL = "SELECT fileid, path FROM oc_filecache WHERE path = %s LIMIT 1;"
+PATH_BY_FILEID_SQL = "SELECT path FROM oc_filecache WHERE fileid = %s LIMIT 1;"
+FNAME_ILIKE_SQL = "SELECT fileid, path FROM oc_filecache WHERE path ILIKE %s ORDER BY fileid DESC LIMIT 1;"
+# MATERIALIZED evita que el planner elija recorrer la pkey por fileid DESC filtrando con ILIKE
+FNAME_TRGM_SQL = """
+WITH m AS MATERIALIZED (SELECT fileid, path FROM oc_filecache WHERE path ILIKE %s)
+SELECT fileid, path FROM m ORDER BY fileid DESC LIMIT 1;
+"""
+
+def setup_filename_lookup():
+    """FILENAME_LOOKUP=trgm: crea pg_trgm y un índice GIN sobre oc_filecache.path (CONCURRENTLY)."""
+    global filename_lookup_mode
+    if FILENAME_LOOKUP != "trgm":
+        return
+    conn = None
+    try:
+        conn = db_connect()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (TRGM_INDEX,))
+            r = cur.fetchone()
+            if r and not r[0]:
+                # build CONCURRENTLY anterior interrumpido
+                cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s;" % TRGM_INDEX)
+            if not r or not r[0]:
+                print("Building", TRGM_INDEX, "on oc_filecache (concurrently)...")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON oc_filecache USING gin (path gin_trgm_ops);" % TRGM_INDEX)
+        filename_lookup_mode = "trgm"
+        print("Filename lookup using pg_trgm index", TRGM_INDEX)
+    except Exception as e:
+        print("pg_trgm unavailable, filename lookup keeps ILIKE scan:", e)
+    finally:
+        if conn is not None:
+            conn.close()
+
+def _basename_key(path):
+    return hash(path.rsplit('/', 1)[-1].lower())
+
+class FileCacheMirror:
+    """
+    Espejo en memoria de oc_filecache para las storages auditadas.
+    El path se guarda una sola vez (fileid -> path); los índices por path y por nombre
+    guardan solo hash(str) -> fileid y se verifican contra el path guardado.
+    Se construye al arrancar y se actualiza por watermark de fileid y mtime.
+    """
+    def __init__(self, storages=FILECACHE_STORAGES, max_rows=FILECACHE_MIRROR_MAX):
+        self.storages = storages
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.ready = False
+        self.paths, self.by_path, self.by_name = {}, {}, {}
+        self.max_fileid = 0
+        self.max_mtime = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _where(self, cond):
+        if self.storages:
+            return " WHERE " + cond + " AND storage = ANY(%s)", [self.storages]
+        return " WHERE " + cond, []
+
+    @staticmethod
+    def _add(paths, by_path, by_name, fid, path):
+        old = paths.get(fid)
+        if old is not None and old != path:
+            if by_path.get(hash(old)) == fid:
+                del by_path[hash(old)]
+            if by_name.get(_basename_key(old)) == fid:
+                del by_name[_basename_key(old)]
+        paths[fid] = path
+        by_path[hash(path)] = fid
+        nk = _basename_key(path)
+        if by_name.get(nk, -1) < fid:
+            by_name[nk] = fid
+
+    def build(self, conn):
+        paths, by_path, by_name = {}, {}, {}
+        max_fid = max_mtime = 0
+        where, args = self._where("true")
+        # cursor con nombre: se lee oc_filecache en streaming, no todo en RAM
+        with conn.cursor(name="audit_filecache_mirror") as cur:
+            cur.itersize = 50000
+            cur.execute("SELECT fileid, path, mtime FROM oc_filecache" + where + ";", args)
+            for fid, path, mtime in cur:
+                if len(paths) >= self.max_rows:
+                    raise OverflowError("oc_filecache has more than FILECACHE_MIRROR_MAX=%d rows" % self.max_rows)
+                self._add(paths, by_path, by_name, fid, path or '')
+                max_fid = max(max_fid, fid)
+                max_mtime = max(max_mtime, mtime or 0)
+        with self.lock:
+            self.paths, self.by_path, self.by_name = paths, by_path, by_name
+            self.max_fileid = max_fid
+            self.max_mtime = min(max_mtime, int(time.time()))
+            self.ready = True
+        return len(paths)
+
+    def refresh(self, conn):
+        rows = []
+        with conn.cursor() as cur:
+            where, args = self._where("fileid > %s")
+            cur.execute("SELECT fileid, path, mtime FROM oc_filecache" + where + " ORDER BY fileid;", [self.max_fileid] + args)
+            rows.extend(cur.fetchall())
+            where, args = self._where("mtime >= %s")
+            cur.execute("SELECT fileid, path, mtime FROM oc_filecache" + where + ";", [self.max_mtime] + args)
+            rows.extend(cur.fetchall())
+        with self.lock:
+            for fid, path, mtime in rows:
+                self._add(self.paths, self.by_path, self.by_name, fid, path or '')
+                self.max_fileid = max(self.max_fileid, fid)
+                # mtime lo pone el cliente: no dejar que uno futuro congele el watermark
+                self.max_mtime = max(self.max_mtime, min(mtime or 0, int(time.time())))
+        return len(rows)
+
+    def path_for_fileid(self, fid):
+        with self.lock:
+            return self.paths.get(fid)
+
+    def lookup(self, path):
+        """Mismo orden que la consulta: path sin '/', path tal cual, y luego por nombre de archivo."""
+        p = path.lstrip('/')
+        with self.lock:
+            for cand in (p, path):
+                fid = self.by_path.get(hash(cand))
+                if fid is not None and self.paths.get(fid) == cand:
+                    self.hits += 1
+                    return (fid, cand)
+            fname = p.split('/')[-1].lower()
+            if fname:
+                fid = self.by_name.get(hash(fname))
+                if fid is not None:
+                    fpath = self.paths.get(fid)
+                    if fpath is not None and fpath.rsplit('/', 1)[-1].lower() == fname:
+                        self.hits += 1
+                        return (fid, fpath)
+            self.misses += 1
+        return (None, None)
+
+    def run(self):
+        last_build = 0
+        while True:
+            try:
+                with db_conn() as conn:
+                    if time.monotonic() - last_build >= FILECACHE_MIRROR_REBUILD or not self.ready:
+                        t0 = time.monotonic()
+                        n = self.build(conn)
+                        last_build = time.monotonic()
+                        print("filecache mirror built: %d rows in %.1fs" % (n, last_build - t0))
+                    else:
+                        self.refresh(conn)
+            except OverflowError as e:
+                print("filecache mirror disabled:", e)
+                with self.lock:
+                    self.ready = False
+                    self.paths, self.by_path, self.by_name = {}, {}, {}
+                return
+            except Exception as e:
+                print("filecache mirror error:", e)
+            time.sleep(FILECACHE_MIRROR_INTERVAL)
+
+    def start(self):
+        threading.Thread(target=self.run, name="filecache-mirror", daemon=True).start()
+
+filecache_mirror = FileCacheMirror()
+
 # map path -> fileid and path
 def find_fileid_and_path(conn, path):
     if not path:
         return (None, None)
-    p = path.lstrip('/')
+    if filecache_mirror.ready:
+        r = filecache_mirror.lookup(path)
+        # un miss puede ser un archivo recién creado que el mirror aún no vio: seguir con la DB
+        if r[0] is not None:
+            return r
+    cached = path_cache.get(path)
+    if cached is not TTLCache.MISS:
+        return cached
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT fileid, path FROM oc_filecache WHERE path = %s LIMIT 1;", (p,))
-            r = cur.fetchone()
-            if r:
-                return (r[0], r[1])
-            cur.execute("SELECT fileid, path FROM oc_filecache WHERE path = %s LIMIT 1;", (path,))
+        r = _find_fileid_and_path_db(conn, path)
+    except Exception as e:
+        print("find_fileid_and_path error:", e)
+        return (None, None)
+    path_cache.put(path, r, negative=r[0] is None)
+    return r
+
+@metrics.timed("find_fileid_and_path")
+def _find_fileid_and_path_db(conn, path):
+    p = path.lstrip('/')
+    with conn.cursor() as cur:
+        cur.execute(FILEID_BY_PATH_SQL, (p,))
+        r = cur.fetchone()
+        if r:
+            return (r[0], r[1])
+        cur.execute(FILEID_BY_PATH_SQL, (path,))
+        r = cur.fetchone()
+        if r:
+            return (r[0], r[1])
+        # fallback por filename
+        fname = p.split('/')[-1]
+        if fname:
+            cur.execute(FNAME_TRGM_SQL if filename_lookup_mode == "trgm" else FNAME_ILIKE_SQL, ('%'+fname+'%',))
             r = cur.fetchone()
             if r:
                 return (r[0], r[1])
-            # fallback por filename
-            fname = p.split('/')[-1]
-            if fname:
-                cur.execute("SELECT fileid, path FROM oc_filecache WHERE path ILIKE %s ORDER BY fileid DESC LIMIT 1;", ('%'+fname+'%',))
-                r = cur.fetchone()
-                if r:
-                    return (r[0], r[1])
-    except Exception as e:
-        print("find_fileid_and_path error:", e)
     return (None, None)
 
 HUMAN_BLACKLIST = set(['nextcloud','system','www-data','cron','root',''])
 
+def _pick_username(unames):
+    # primer usuario humano entre los más recientes; si no hay, el más reciente tal cual
+    for u in unames:
+        uname = (u or '').strip()
+        if uname and uname not in HUMAN_BLACKLIST:
+            return uname
+    if unames:
+        return (unames[0] or None)
+    return None
+
+USERNAMES_BY_FILEIDS_SQL = """
+SELECT object_id, username FROM (
+    SELECT object_id, COALESCE("user", affecteduser) AS username,
+           row_number() OVER (PARTITION BY object_id ORDER BY timestamp DESC) AS rn
+    FROM oc_activity
+    WHERE object_id = ANY(%s) AND app='files'
+) ranked
+WHERE rn <= 20
+ORDER BY object_id, rn;
+"""
+USERNAME_BY_FILEID_SQL = """
+SELECT COALESCE("user", affecteduser) AS username, timestamp
+FROM oc_activity
+WHERE object_id = %s AND app='files'
+ORDER BY timestamp DESC
+LIMIT 20;
+"""
+USERNAME_BY_PATH_SQL = """
+SELECT COALESCE("user", affecteduser) AS username, timestamp
+FROM oc_activity
+WHERE app='files' AND (file = %s OR subjectparams::text LIKE %s)
+ORDER BY timestamp DESC
+LIMIT 20;
+"""
+
+@metrics.timed("find_usernames_for_fileids")
+def find_usernames_for_fileids(conn, fileids):
+    """Una sola consulta para varios object_id: {fileid: username} (top 20 por objeto, como la consulta individual)."""
+    fileids = sorted(set(int(f) for f in fileids if f))
+    if not fileids:
+        return {}
+    by_fid = {}
+    with conn.cursor() as cur:
+        cur.execute(USERNAMES_BY_FILEIDS_SQL, (fileids,))
+        for fid, uname in cur.fetchall():
+            by_fid.setdefault(fid, []).append(uname)
+    return dict((fid, _pick_username(unames)) for fid, unames in by_fid.items())
+
+@metrics.timed("find_username_for_fileid_or_path")
 def find_username_for_fileid_or_path(conn, fileid=None, path=None):
     try:
         with conn.cursor() as cur:
             if fileid:
-                cur.execute("""
-                    SELECT COALESCE("user", affecteduser) AS username, timestamp
-                    FROM oc_activity
-                    WHERE object_id = %s AND app='files'
-                    ORDER BY timestamp DESC
-                    LIMIT 20;
-                """, (fileid,))
+                cur.execute(USERNAME_BY_FILEID_SQL, (fileid,))
                 rows = cur.fetchall()
-                for r in rows:
-                    uname = (r[0] or '').strip()
-                    if uname and uname not in HUMAN_BLACKLIST:
-                        return uname
                 if rows:
-                    return (rows[0][0] or None)
+                    return _pick_username([r[0] for r in rows])
             if path:
-                cur.execute("""
-                    SELECT COALESCE("user", affecteduser) AS username, timestamp
-                    FROM oc_activity
-                    WHERE app='files' AND (file = %s OR subjectparams::text LIKE %s)
-                    ORDER BY timestamp DESC
-                    LIMIT 20;
-                """, (path, '%' + path + '%'))
+                cur.execute(USERNAME_BY_PATH_SQL, (path, '%' + path + '%'))
                 rows = cur.fetchall()
-                for r in rows:
-                    uname = (r[0] or '').strip()
-                    if uname and uname not in HUMAN_BLACKLIST:
-                        return uname
                 if rows:
-                    return (rows[0][0] or None)
+                    return _pick_username([r[0] for r in rows])
     except Exception as e:
         print("find_username_for_fileid_or_path error:", e)
     return None
 
-# utilities
-def normalize_resource(r):
-    if not r:
-        return r
-    r2 = r.split('?',1)[0]
-    try:
-        from urllib.parse import unquote
-        r2 = unquote(r2)
-    except Exception:
-        pass
-    return r2.rstrip('/')
+DAV_RELATIVE_RE = re.compile(r'^/remote\.php/(?:dav/files/[^/]+|webdav)(/.+)$')
 
-def detect_event_type(method, status, resource):
-    try:
-        from urllib.parse import urlparse, parse_qs
-        up = urlparse(resource)
-        qs = parse_qs(up.query or "")
-        path = up.path or resource
-    except Exception:
-        path = resource; qs = {}
-    m = method.upper()
-    if 'download' in (path or "").lower() or 'download' in (",".join(qs.keys()).lower()):
-        return "download"
-    if m == "PROPFIND":
-        return "list"
-    if m == "GET" and status == 200 and FILE_EXT_RE.search(path or ""):
-        return "download"
-    if m == "GET" and status == 200:
-        return "view"
-    return "other"
+class ActivityFeed:
+    """
+    Cola de oc_activity en memoria: se leen las filas nuevas por watermark de activity_id
+    cada ACTIVITY_FEED_INTERVAL y se guardan los últimos 20 usuarios por object_id y por `file`.
+    La atribución pasa a ser un lookup en memoria (sin el LIKE sobre subjectparams).
+    """
+    def __init__(self, max_objects=ACTIVITY_FEED_MAX_OBJECTS):
+        self.max_objects = max(1, max_objects)
+        self.by_object = OrderedDict()
+        self.by_path = OrderedDict()
+        self.lock = threading.Lock()
+        self.watermark = 0
+        self.ready = False
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, index, key, uname):
+        ring = index.get(key)
+        if ring is None:
+            ring = index[key] = deque(maxlen=20)
+        else:
+            index.move_to_end(key)
+        ring.append(uname)
+        while len(index) > self.max_objects:
+            index.popitem(last=False)
+
+    def _apply(self, rows):
+        with self.lock:
+            for activity_id, object_id, fpath, uname in rows:
+                if object_id:
+                    self._remember(self.by_object, int(object_id), uname)
+                if fpath:
+                    self._remember(self.by_path, fpath, uname)
+                self.watermark = max(self.watermark, activity_id)
+
+    def seed(self, conn, seconds=ACTIVITY_FEED_SEED):
+        with conn.cursor() as cur:
+            cur.execute("SELECT coalesce(max(activity_id), 0) FROM oc_activity;")
+            top = cur.fetchone()[0]
+            cur.execute("""
+                SELECT activity_id, object_id, file, COALESCE("user", affecteduser)
+                FROM oc_activity
+                WHERE app='files' AND activity_id <= %s AND timestamp >= extract(epoch from now())::bigint - %s
+                ORDER BY timestamp, activity_id;
+            """, (top, seconds))
+            rows = cur.fetchall()
+        self._apply(rows)
+        with self.lock:
+            self.watermark = max(self.watermark, top)
+            self.ready = True
+        return len(rows)
+
+    def poll(self, conn, limit=10000):
+        n = 0
+        while True:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT activity_id, object_id, file, COALESCE("user", affecteduser)
+                    FROM oc_activity
+                    WHERE activity_id > %s AND app='files'
+                    ORDER BY activity_id
+                    LIMIT %s;
+                """, (self.watermark, limit))
+                rows = cur.fetchall()
+            self._apply(rows)
+            n += len(rows)
+            if len(rows) < limit:
+                return n
+
+    def usernames_for_fileids(self, fileids):
+        out = {}
+        with self.lock:
+            for fid in fileids:
+                ring = self.by_object.get(int(fid)) if fid else None
+                if ring:
+                    out[fid] = _pick_username(list(reversed(ring)))
+                    self.hits += 1
+                elif fid:
+                    self.misses += 1
+        return out
 
+    def username_for_path(self, path):
+        if not path:
+            return None
+        cands = [path]
+        m = DAV_RELATIVE_RE.match(path)
+        if m:
+            cands.append(m.group(1))
+        with self.lock:
+            for c in cands:
+                ring = self.by_path.get(c)
+                if ring:
+                    self.hits += 1
+                    return _pick_username(list(reversed(ring)))
+            self.misses += 1
+        return None
+
+    def run(self):
+        while True:
+            try:
+                with db_conn() as conn:
+                    if not self.ready:
+                        print("activity feed seeded with", self.seed(conn), "rows")
+                    else:
+                        self.poll(conn)
+            except Exception as e:
+                print("activity feed error:", e)
+            time.sleep(ACTIVITY_FEED_INTERVAL)
+
+    def start(self):
+        threading.Thread(target=self.run, name="activity-feed", daemon=True).start()
+
+activity_feed = ActivityFeed()
+
+SIMILAR_BY_OBJECT_SQL = """
+SELECT 1 FROM audit_events
+WHERE object_id = %s
+  AND coalesce(username,'(unknown)') = coalesce(%s,'(unknown)')
+  AND ip = %s
+  AND method = %s
+  AND abs(extract(epoch from ts - %s::timestamptz)) <= %s
+LIMIT 1;
+"""
+SIMILAR_BY_RESOURCE_SQL = """
+SELECT 1 FROM audit_events
+WHERE md5(resource) = md5(%s::text) AND resource = %s
+  AND coalesce(username,'(unknown)') = coalesce(%s,'(unknown)')
+  AND ip = %s
+  AND method = %s
+  AND abs(extract(epoch from ts - %s::timestamptz)) <= %s
+LIMIT 1;
+"""
+
+@metrics.timed("already_similar")
 def already_similar(conn, ts, username, ip, method, resource, object_id):
     try:
         with conn.cursor() as cur:
             if object_id:
-                q = """
-                SELECT 1 FROM audit_events
-                WHERE object_id = %s
-                  AND coalesce(username,'(unknown)') = coalesce(%s,'(unknown)')
-                  AND ip = %s
-                  AND method = %s
-                  AND abs(extract(epoch from ts - %s::timestamptz)) <= %s
-                LIMIT 1;
-                """
-                cur.execute(q, (object_id, username, ip, method, ts, DEDUPE_SECONDS))
+                cur.execute(SIMILAR_BY_OBJECT_SQL, (object_id, username, ip, method, ts, DEDUPE_SECONDS))
                 if cur.fetchone():
                     return True
-            q2 = """
-            SELECT 1 FROM audit_events
-            WHERE resource = %s
-              AND coalesce(username,'(unknown)') = coalesce(%s,'(unknown)')
-              AND ip = %s
-              AND method = %s
-              AND abs(extract(epoch from ts - %s::timestamptz)) <= %s
-            LIMIT 1;
-            """
-            cur.execute(q2, (resource, username, ip, method, ts, DEDUPE_SECONDS))
+            cur.execute(SIMILAR_BY_RESOURCE_SQL, (resource, resource, username, ip, method, ts, DEDUPE_SECONDS))
             return cur.fetchone() is not None
     except Exception as e:
         print("already_similar DB error:", e)
         return False
 
-def _insert_event_db(ev, object_id=None, resolved_path=None):
+def _ts_epoch(ts):
+    # naive -> se asume UTC (datetime.utcnow / dtparser sin offset)
+    if ts is None:
+        return time.time()
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+class DedupeCache:
+    """
+    Índice de dedupe en memoria (reemplaza los SELECT de already_similar).
+    Buckets de DEDUPE_SECONDS por ts del evento; clave (object_id o resource, username, ip, method).
+    Se conservan los buckets dentro de `horizon` segundos del ts más nuevo visto; eventos más viejos
+    que lo que el índice cubre (replay del initial scan) se marcan para verificar contra la DB.
+    """
+    def __init__(self, window=DEDUPE_SECONDS, horizon=None):
+        self.window = window
+        self.width = max(1, window)
+        self.horizon = horizon if horizon is not None else window + RESOLVE_WAIT + 5
+        self.buckets = {}
+        self.high = None
+        self.valid_from = time.time()
+        self.lock = threading.Lock()
+
+    def _keys(self, username, ip, method, resource, object_id):
+        u = username or '(unknown)'
+        keys = [('r', resource, u, ip, method)]
+        if object_id:
+            keys.append(('o', object_id, u, ip, method))
+        return keys
+
+    def _hit(self, t, keys):
+        b = int(t // self.width)
+        for bi in (b - 1, b, b + 1):
+            bucket = self.buckets.get(bi)
+            if not bucket:
+                continue
+            for k in keys:
+                for t2 in bucket.get(k, ()):
+                    if abs(t - t2) <= self.window:
+                        return True
+        return False
+
+    def _add(self, t, keys):
+        bucket = self.buckets.setdefault(int(t // self.width), {})
+        for k in keys:
+            bucket.setdefault(k, []).append(t)
+        if self.high is None or t > self.high:
+            self.high = t
+            self._prune()
+
+    def _prune(self):
+        cutoff = self.high - self.horizon
+        for bi in [bi for bi in self.buckets if (bi + 1) * self.width < cutoff]:
+            del self.buckets[bi]
+            self.valid_from = max(self.valid_from, (bi + 1) * self.width)
+
+    def check_and_add(self, ts, username, ip, method, resource, object_id):
+        """Devuelve (duplicado, verificar_en_db). Si no es duplicado queda registrado."""
+        t = _ts_epoch(ts)
+        keys = self._keys(username, ip, method, resource, object_id)
+        with self.lock:
+            if self._hit(t, keys):
+                return True, False
+            self._add(t, keys)
+            return False, DEDUPE_DB_FALLBACK or t - self.window < self.valid_from
+
+    def seed(self, conn, seconds=DEDUPE_SEED_SECONDS):
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT ts, username, ip, method, resource, object_id FROM audit_events
+                WHERE ts >= now() - %s * interval '1 second';
+            """, (seconds,))
+            rows = cur.fetchall()
+        with self.lock:
+            for ts, username, ip, method, resource, object_id in rows:
+                self._add(_ts_epoch(ts), self._keys(username, ip, method, resource, object_id))
+            self.valid_from = time.time() - seconds
+        return len(rows)
+
+dedupe = DedupeCache()
+
+INSERT_SQL = """
+INSERT INTO audit_events (ts, username, ip, method, original_resource, resource, object_id, status, size, user_agent, referrer, raw_line, event_type)
+VALUES %s
+"""
+
+def db_error_is_transient(e):
+    """
+    True si el error es de conexión o del servidor (reintentar el lote entero más tarde); False si es
+    de los datos de una fila. Se decide por SQLSTATE: psycopg2 clasifica como OperationalError también
+    errores de fila como 54000 (index row size exceeds btree maximum). Sirve para psycopg2 y asyncpg.
+    """
+    code = getattr(e, 'pgcode', None) or getattr(e, 'sqlstate', None)
+    if not code:
+        # sin SQLSTATE: conexión caída, timeout de red, error del driver
+        return True
+    # 08 conexión, 40 serialización/deadlock, 53 recursos, 57 intervención del operador, 58 sistema
+    return code[:2] in ('08', '40', '53', '57', '58')
+
+class AuditWriter:
+    """
+    Etapa de escritura: los eventos resueltos se encolan y un thread los inserta en lotes
+    (execute_values) cuando se juntan WRITE_BATCH_SIZE o pasan WRITE_FLUSH_INTERVAL segundos.
+    Tras cada commit se cierran las marcas de checkpoint del lote y se guarda el checkpoint.
+    Si el lote falla por los datos (no por la conexión) se reintenta fila por fila y se descartan
+    las que no se pueden insertar, para que una fila inválida no frene la cola.
+    close() hace un flush síncrono de lo que quede en cola.
+    """
+    _STOP = object()
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, maxsize=WRITE_QUEUE_MAX):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.q = queue.Queue(maxsize=maxsize)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, row, check_db=False, ckpt=None, trace=None):
+        # bloquea si la cola está llena (backpressure hacia los resolvers)
+        self.q.put((row, check_db, ckpt, trace))
+
+    def close(self, timeout=30):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.q.put(self._STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            if len(batch) >= self.batch_size:
+                # el último flush falló: no leer más hasta poder escribir
+                time.sleep(self.flush_interval)
+                if self._flush(batch):
+                    batch = []
+                continue
+            try:
+                item = self.q.get(timeout=max(0, deadline - time.monotonic()) if batch else None)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                # drenar lo que haya quedado y último flush
+                while True:
+                    try:
+                        item = self.q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not self._STOP:
+                        batch.append(item)
+                if batch and not self._flush(batch):
+                    print("audit writer: %d events could not be written at shutdown" % len(batch))
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                if self._flush(batch):
+                    batch = []
+                else:
+                    deadline = time.monotonic() + self.flush_interval
+
+    @metrics.timed("writer_flush")
+    def _flush(self, batch):
+        traces = [tr for _, _, _, tr in batch if tr]
+        for tr in traces:
+            tr.mark("queue")
+        try:
+            with db_conn() as conn:
+                rows = []
+                for row, check_db, _, _ in batch:
+                    # solo eventos fuera de lo que cubre el índice en memoria (o DEDUPE_DB_FALLBACK=1);
+                    # con los índices únicos de dedupe la DB descarta los duplicados en el INSERT
+                    if check_db and not dedupe_unique_active and already_similar(conn, row[0], row[1], row[2], row[3], row[5], row[6]):
+                        continue
+                    rows.append(row)
+                inserted = failed = 0
+                if rows:
+                    sql = INSERT_SQL + " ON CONFLICT DO NOTHING" if dedupe_unique_active else INSERT_SQL
+                    with conn.cursor() as cur:
+                        cur.execute("SAVEPOINT audit_batch;")
+                        try:
+                            execute_values(cur, sql, rows, page_size=len(rows))
+                            inserted = cur.rowcount if cur.rowcount >= 0 else len(rows)
+                        except psycopg2.Error as e:
+                            if db_error_is_transient(e):
+                                raise
+                            cur.execute("ROLLBACK TO SAVEPOINT audit_batch;")
+                            print("audit writer batch error, retrying row by row:", str(e).strip())
+                            inserted, failed = self._insert_rows(cur, sql, rows)
+                    conn.commit()
+            print("audit writer: flushed %d events (%d duplicates skipped, %d failed)" % (
+                inserted, len(batch) - inserted - failed, failed))
+            metrics.INSERT_BATCH_SIZE.observe(inserted)
+            metrics.DEDUPE_DROPPED.inc(len(batch) - inserted - failed, stage="db")
+            metrics.INSERT_FAILED.inc(failed)
+            mark_done(*[ckpt for _, _, ckpt, _ in batch])
+            checkpoints.save()
+            for tr in traces:
+                tr.mark("insert")
+                tracing.finish(tr, "written")
+            return True
+        except Exception as e:
+            print("audit writer flush error:", e)
+            traceback.print_exc()
+            return False
+
+    def _insert_rows(self, cur, sql, rows):
+        # una fila por savepoint: las que fallan se registran y se descartan; (insertadas, descartadas)
+        inserted = failed = 0
+        for row in rows:
+            cur.execute("SAVEPOINT audit_row;")
+            try:
+                execute_values(cur, sql, [row])
+                inserted += cur.rowcount if cur.rowcount >= 0 else 1
+            except psycopg2.Error as e:
+                if db_error_is_transient(e):
+                    raise
+                cur.execute("ROLLBACK TO SAVEPOINT audit_row;")
+                failed += 1
+                print("audit writer: dropping event that cannot be inserted:", row[0], row[2], row[3],
+                      (row[4] or '')[:200], "-", str(e).strip())
+            cur.execute("RELEASE SAVEPOINT audit_row;")
+        return inserted, failed
+
+writer = AuditWriter()
+checkpoints = Checkpoints(CHECKPOINT_FILE)
+
+def event_row(ev, object_id=None, resolved_path=None):
+    """Fila de audit_events (orden de INSERT_SQL) para el evento, o None si no se registra (PROPFIND)."""
     # original_resource = raw URL; resource = resolved human path (if available)
     orig = normalize_resource(ev.get('resource'))
     ev['event_type'] = detect_event_type(ev.get('method','GET'), int(ev.get('status') or 0), orig or '')
     if ev.get('method','').upper() == "PROPFIND":
+        return None
+    return (
+        ev.get('ts'),
+        ev.get('username'),
+        ev.get('ip'),
+        ev.get('method'),
+        orig,
+        resolved_path or orig,
+        object_id,
+        int(ev.get('status') or 0),
+        int(ev.get('size') or 0) if ev.get('size') not in (None,'-') else None,
+        ev.get('ua'),
+        ev.get('referrer'),
+        ev.get('raw'),
+        ev.get('event_type')
+    )
+
+def _insert_event_db(ev, object_id=None, resolved_path=None, ckpt=None, trace=None):
+    """Prepara la fila y la encola en el writer (con su marca de checkpoint). True si quedó encolada."""
+    if trace:
+        trace.mark("resolve")
+    row = event_row(ev, object_id, resolved_path)
+    if row is None:
         return False
-    try:
-        with db_connect() as conn:
-            if already_similar(conn, ev.get('ts'), ev.get('username'), ev.get('ip'), ev.get('method'), resolved_path or orig, object_id):
-                return False
-            sql = """
-            INSERT INTO audit_events (ts, username, ip, method, original_resource, resource, object_id, status, size, user_agent, referrer, raw_line, event_type)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            """
-            with conn.cursor() as cur:
-                cur.execute(sql, (
-                    ev.get('ts'),
-                    ev.get('username'),
-                    ev.get('ip'),
-                    ev.get('method'),
-                    orig,
-                    resolved_path or orig,
-                    object_id,
-                    int(ev.get('status') or 0),
-                    int(ev.get('size') or 0) if ev.get('size') not in (None,'-') else None,
-                    ev.get('ua'),
-                    ev.get('referrer'),
-                    ev.get('raw'),
-                    ev.get('event_type')
-                ))
-            conn.commit()
-            return True
-    except Exception as e:
-        print("insert_event DB error:", e)
-        traceback.print_exc()
+    dup, check_db = dedupe.check_and_add(row[0], row[1], row[2], row[3], row[5], row[6])
+    if trace:
+        trace.mark("dedupe")
+    if dup:
+        metrics.DEDUPE_DROPPED.inc(stage="memory")
         return False
+    writer.put(row, check_db, ckpt, trace)
+    return True
 
 # correlation memory
-recent_actions = {}
-recent_lock = threading.Lock()
+def _grams(s):
+    return set(s[i:i + 3] for i in range(len(s) - 2))
+
+class SubstringIndex:
+    """
+    Índice por trigramas: related(q) devuelve los strings guardados s con `s in q or q in s`
+    (la contención del recorrido del dict anterior) sin recorrerlos todos.
+    q dentro de s: candidatos = los que tienen el trigrama de q con menos strings.
+    s dentro de q: cada s se ancla en uno de sus trigramas (el menos usado al guardarlo); si s está
+    en q, su ancla también, así que alcanza con mirar las anclas de los trigramas de q.
+    Los de menos de 3 caracteres se comparan siempre. Sin lock propio: lo protege el dueño.
+    """
+    def __init__(self):
+        self.postings = {}    # trigrama -> strings que lo contienen
+        self.anchors = {}     # trigrama -> strings anclados en él
+        self.anchor_of = {}   # string -> su ancla (None si es corto)
+        self.short = set()
+
+    def add(self, s):
+        if s in self.anchor_of:
+            return
+        grams = _grams(s)
+        if not grams:
+            self.anchor_of[s] = None
+            self.short.add(s)
+            return
+        anchor = min(grams, key=lambda g: len(self.postings.get(g, ())))
+        for g in grams:
+            self.postings.setdefault(g, set()).add(s)
+        self.anchors.setdefault(anchor, set()).add(s)
+        self.anchor_of[s] = anchor
+
+    def discard(self, s):
+        if s not in self.anchor_of:
+            return
+        anchor = self.anchor_of.pop(s)
+        if anchor is None:
+            self.short.discard(s)
+            return
+        for g in _grams(s):
+            p = self.postings[g]
+            p.discard(s)
+            if not p:
+                del self.postings[g]
+        a = self.anchors[anchor]
+        a.discard(s)
+        if not a:
+            del self.anchors[anchor]
+
+    def related(self, q):
+        out = set(s for s in self.short if s in q or q in s)
+        grams = _grams(q)
+        if not grams:
+            # q de menos de 3 caracteres: puede estar dentro de cualquiera
+            out.update(s for s in self.anchor_of if q in s)
+            return out
+        rarest = min(grams, key=lambda g: len(self.postings.get(g, ())))
+        out.update(s for s in self.postings.get(rarest, ()) if q in s)
+        for g in grams:
+            for s in self.anchors.get(g, ()):
+                if s in q:
+                    out.add(s)
+        return out
+
+class CorrelationStore:
+    """
+    Acciones recientes del app log (recurso -> usuario) para guess_username.
+    Expiración por heap de timestamps (sin barrer todo en cada insert), lookup exacto por dict y
+    SubstringIndex para la contención en ambos sentidos (recurso guardado dentro del buscado o al revés).
+    Ante varios candidatos gana el más antiguo, como el recorrido en orden de inserción del dict anterior.
+    """
+    def __init__(self, window=CORRELATION_WINDOW):
+        self.window = window
+        self.entries = {}      # resource -> (user, ts_epoch, seq)
+        self.expiry = []       # heap (ts_epoch, resource); las entradas reemplazadas se ignoran al salir
+        self.index = SubstringIndex()
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        while self.expiry and self.expiry[0][0] < cutoff:
+            ts, resource = heapq.heappop(self.expiry)
+            e = self.entries.get(resource)
+            if e is not None and e[1] == ts:
+                del self.entries[resource]
+                self.index.discard(resource)
+
+    def add(self, resource, user, ts):
+        t = _ts_epoch(ts)
+        with self.lock:
+            e = self.entries.get(resource)
+            if e is None:
+                self.seq += 1
+                self.entries[resource] = (user, t, self.seq)
+                self.index.add(resource)
+            else:
+                # como en el dict: se actualiza el valor y se conserva la posición (seq)
+                self.entries[resource] = (user, t, e[2])
+            heapq.heappush(self.expiry, (t, resource))
+            self._prune(time.time())
+
+    def guess(self, resource):
+        now = time.time()
+        with self.lock:
+            # sin podar aquí: como en el dict anterior solo se poda en add, y así una entrada vencida
+            # que se actualiza antes de esa poda conserva su lugar en el orden
+            e = self.entries.get(resource)
+            if e is not None and now - e[1] <= self.window:
+                return e[0]
+            best = None
+            for k in self.index.related(resource):
+                u, t, seq = self.entries[k]
+                if now - t <= self.window and (best is None or seq < best[1]):
+                    best = (u, seq)
+            return best[0] if best else None
+
+correlation = CorrelationStore()
+
+# wake(resource) de los motores en marcha: una acción nueva en el app log adelanta el
+# próximo intento de las resoluciones pendientes de ese recurso
+resolution_wakers = []
+
 def add_recent_action(resource, user, ts):
     if not resource or not user:
         return
-    with recent_lock:
-        recent_actions[resource] = (user, ts)
-        cutoff = datetime.utcnow() - timedelta(seconds=CORRELATION_WINDOW)
-        for k,(u,t) in list(recent_actions.items()):
-            if t < cutoff:
-                recent_actions.pop(k,None)
+    correlation.add(resource, user, ts)
+    for wake in resolution_wakers:
+        wake(resource)
 
 def guess_username(resource):
     if not resource:
         return None
-    with recent_lock:
-        v = recent_actions.get(resource)
-        if v:
-            user,ts = v
-            if datetime.utcnow() - ts <= timedelta(seconds=CORRELATION_WINDOW):
-                return user
-        for k,(u,t) in recent_actions.items():
-            if datetime.utcnow() - t > timedelta(seconds=CORRELATION_WINDOW):
-                continue
-            if k in resource or resource in k:
-                return u
-    return None
+    return correlation.guess(resource)
+
+class PendingIndex:
+    """
+    Recurso normalizado -> clave de pending, para las wake-ups desde el app log: keys_for(r) da las
+    claves cuyo recurso contiene a r o está contenido en él, el mismo criterio con el que
+    guess_username va a encontrar la acción nueva. Lo protege el lock del registro.
+    """
+    def __init__(self):
+        self.by_res = {}
+        self.paths = SubstringIndex()
+
+    def add(self, res, key):
+        if res:
+            self.by_res[res] = key
+            self.paths.add(res)
+
+    def discard(self, res, key):
+        if res and self.by_res.get(res) == key:
+            del self.by_res[res]
+            self.paths.discard(res)
+
+    def keys_for(self, resource):
+        return set(self.by_res[r] for r in self.paths.related(resource))
+
+    def clear(self):
+        self.by_res = {}
+        self.paths = SubstringIndex()
 
 # pending resolution keyed by canonical id
 pending = {}
+pending_index = PendingIndex()
 pending_lock = threading.Lock()
+# productores esperan aquí cuando pending llega a MAX_PENDING (backpressure)
+pending_space = threading.Condition(pending_lock)
 
-def canonical_key_for_resource(resource):
-    res = normalize_resource(resource or '')
-    m = re.search(r'fileId=(\d+)', res)
-    if not m:
-        m = re.search(r'/download/(\d+)', res)
-    if not m:
-        m = re.search(r'/wopi/files/(\d+)_', res)
-    if m:
+@metrics.timed("path_for_fileid")
+def _path_for_fileid(conn, object_id):
+    if filecache_mirror.ready:
+        p = filecache_mirror.path_for_fileid(object_id)
+        if p:
+            return '/' + p if not p.startswith('/') else p
+    with conn.cursor() as cur:
+        cur.execute(PATH_BY_FILEID_SQL, (object_id,))
+        r = cur.fetchone()
+    if r and r[0]:
+        return '/' + r[0] if not r[0].startswith('/') else r[0]
+    return None
+
+@contextmanager
+def _key_savepoint(conn):
+    """
+    Consultas de una sola clave dentro de la transacción compartida del lote: si fallan (también
+    cuando el helper se traga la excepción y deja la transacción abortada) se vuelve al savepoint
+    y las demás claves del lote siguen. Los errores de conexión sí cortan el lote.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SAVEPOINT resolve_key;")
+    failed = False
+    try:
+        yield
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        raise
+    except Exception as e:
+        print("resolve lookup error:", e)
+        failed = True
+    with conn.cursor() as cur:
+        if failed or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            cur.execute("ROLLBACK TO SAVEPOINT resolve_key;")
+        cur.execute("RELEASE SAVEPOINT resolve_key;")
+
+def _resolve_batch(items):
+    """
+    Un intento de resolución para varias claves due a la vez (antes, una iteración del while de cada worker).
+    Los usernames por object_id salen de una sola consulta a oc_activity. Devuelve las claves insertadas.
+    Las filas se encolan en el writer después de devolver la conexión: con la cola llena writer.put
+    bloquea, y el writer necesita una conexión del pool para vaciarla.
+    """
+    done = set()
+    resolved = []
+    for key, st in items:
+        gu = guess_username(st['res'])
+        if gu:
+            st['ev']['username'] = gu
+    try:
+        with db_conn() as conn:
+            # una transacción para todo el lote: cada clave en su savepoint, un error no aborta a las demás
+            for key, st in items:
+                with _key_savepoint(conn):
+                    if not st['object_id']:
+                        fid,path = find_fileid_and_path(conn, st['res'])
+                        if fid:
+                            st['object_id'] = fid
+                            st['resolved_path'] = '/' + path if path and not path.startswith('/') else path
+                    elif not st['resolved_path']:
+                        # si ya teníamos object_id, obtener path
+                        st['resolved_path'] = _path_for_fileid(conn, st['object_id'])
+            fids = [st['object_id'] for _, st in items if st['object_id']]
+            by_fid = activity_feed.usernames_for_fileids(fids) if activity_feed.ready else {}
+            with _key_savepoint(conn):
+                # memoria primero; a la DB solo los object_id sin actividad reciente (consulta indexada)
+                by_fid.update(find_usernames_for_fileids(conn, [f for f in fids if f not in by_fid]))
+            for key, st in items:
+                uname = by_fid.get(st['object_id']) if st['object_id'] else None
+                if not uname:
+                    # sin actividad para el object_id: buscar por path
+                    if activity_feed.ready:
+                        uname = activity_feed.username_for_path(st['res'])
+                    else:
+                        with _key_savepoint(conn):
+                            uname = find_username_for_fileid_or_path(conn, None, st['res'])
+                if uname:
+                    st['ev']['username'] = uname
+                    resolved.append((key, st))
+    except Exception as e:
+        print("worker db resolution error:", e)
+    for key, st in resolved:
+        # insertar con resource resuelto si disponible
+        if _insert_event_db(st['ev'], st['object_id'], st['resolved_path'], st['ckpt'], st['trace']):
+            print("Inserted (resolved-db canonical):", key, st['ev']['username'], "->", st['resolved_path'] or st['res'])
+            done.add(key)
+    # si ya tenemos username por guess > insertar ahora
+    for key, st in items:
+        if key not in done and st['ev'].get('username'):
+            if _insert_event_db(st['ev'], st['object_id'], st['resolved_path'], st['ckpt'], st['trace']):
+                print("Inserted (resolved-early):", key, st['ev'].get('username'), "->", st['resolved_path'] or st['res'])
+                done.add(key)
+    return done
+
+def _resolve_final(key, st):
+    # final attempt: guess username and insert
+    ev_local = st['ev']
+    final_guess = guess_username(st['res'])
+    if final_guess:
+        ev_local['username'] = final_guess
+    if not st['resolved_path'] and st['object_id']:
+        # intentar una última vez obtener path
         try:
-            fid = int(m.group(1))
-            return ("fileid:%d" % fid, fid)
-        except:
+            with db_conn() as conn:
+                st['resolved_path'] = _path_for_fileid(conn, st['object_id'])
+        except Exception:
             pass
-    return ("resource:%s" % res, None)
+    if _insert_event_db(ev_local, st['object_id'], st['resolved_path'], st['ckpt'], st['trace']):
+        print("Inserted (final canonical):", key, ev_local.get('username'), "->", st['resolved_path'] or st['res'])
+    else:
+        # descartado (dedupe, PROPFIND): la línea ya no tiene nada pendiente
+        mark_done(st['ckpt'])
+        tracing.finish(st['trace'], "dropped")
+
+def next_resolve_due(attempts, deadline, now):
+    """
+    (due, final) del próximo intento tras `attempts` intentos sin resolver: backoff exponencial
+    desde RESOLVE_INTERVAL con jitter; el que caería después del deadline pasa a ser el intento
+    final, en el deadline (un intento completo y, si no resuelve, _resolve_final). Lo usan ambos
+    motores (now/deadline en el reloj de cada uno).
+    """
+    delay = min(RESOLVE_BACKOFF_MAX, RESOLVE_INTERVAL * RESOLVE_BACKOFF_FACTOR ** min(max(0, attempts - 1), 16))
+    due = now + delay * (1 + random.uniform(-RESOLVE_JITTER, RESOLVE_JITTER))
+    if due >= deadline:
+        return deadline, True
+    return due, False
 
-def schedule_resolution_and_insert(ev):
+class ResolutionScheduler:
+    """
+    Pool fijo de workers para las resoluciones pendientes.
+    Cada clave de `pending` tiene una entrada en un heap ordenado por el próximo intento
+    (backoff de next_resolve_due hasta RESOLVE_WAIT); cada worker toma todas las claves ya due
+    (hasta RESOLVE_BATCH) y las resuelve juntas en vez de tener un thread durmiendo por evento.
+    wake() adelanta el intento de las claves cuyo recurso coincide (o por contención) con una
+    acción nueva del app log.
+    """
+    def __init__(self, workers=RESOLVE_WORKERS):
+        self.workers = max(1, workers)
+        self.heap = []
+        self.seq = 0
+        self.ready = threading.Condition(pending_lock)
+        self.threads = []
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name="resolver-%d" % i, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _push(self, key, due):
+        # llamar con pending_lock tomado; la entrada anterior de la clave queda invalidada por seq
+        self.seq += 1
+        pending[key]['seq'] = self.seq
+        heapq.heappush(self.heap, (due, self.seq, key))
+        self.ready.notify()
+
+    def wake(self, resource):
+        with pending_lock:
+            for key in pending_index.keys_for(resource):
+                st = pending.get(key)
+                if st is None:
+                    continue
+                metrics.RESOLUTION_WAKEUPS.inc()
+                if st['busy']:
+                    # en un intento ahora mismo: repetir apenas termine
+                    st['wake'] = True
+                else:
+                    self._push(key, time.monotonic())
+
+    def _next_batch(self):
+        with pending_lock:
+            while True:
+                if self.stopping:
+                    return None
+                if self.heap:
+                    now = time.monotonic()
+                    wait = self.heap[0][0] - now
+                    if wait <= 0:
+                        batch = []
+                        while self.heap and self.heap[0][0] <= now and len(batch) < RESOLVE_BATCH:
+                            _, seq, key = heapq.heappop(self.heap)
+                            st = pending.get(key)
+                            if st is not None and st['seq'] == seq:
+                                st['busy'] = True
+                                batch.append((key, st))
+                        return batch
+                    self.ready.wait(wait)
+                else:
+                    self.ready.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            done = set()
+            metrics.RESOLUTION_ATTEMPTS.inc(len(batch))
+            for key, st in batch:
+                if st['trace']:
+                    st['trace'].attempt()
+            # el intento en el deadline también consulta oc_activity; solo lo que siga sin resolver va al final
+            try:
+                done = _resolve_batch(batch)
+            except Exception as e:
+                print("resolver error:", e)
+                traceback.print_exc()
+            finals = set()
+            for key, st in batch:
+                if st['final'] and key not in done:
+                    try:
+                        _resolve_final(key, st)
+                    except Exception as e:
+                        print("resolver error:", key, e)
+                        traceback.print_exc()
+                        mark_done(st['ckpt'])
+                        tracing.finish(st['trace'], "error")
+                    finals.add(key)
+            done |= finals
+            with pending_lock:
+                for key, st in batch:
+                    if key not in done:
+                        if st['trace']:
+                            st['trace'].mark("resolve")
+                        st['busy'] = False
+                        st['attempts'] += 1
+                        now = time.monotonic()
+                        if st['wake']:
+                            st['wake'] = False
+                            due, st['final'] = now, now >= st['deadline']
+                        else:
+                            due, st['final'] = next_resolve_due(st['attempts'], st['deadline'], now)
+                        self._push(key, due)
+                    else:
+                        pending.pop(key, None)
+                        pending_index.discard(st['res'], key)
+                        metrics.RESOLUTION_SECONDS.observe(time.monotonic() - (st['deadline'] - RESOLVE_WAIT),
+                                                           outcome="final" if key in finals else "resolved")
+                pending_space.notify_all()
+
+    def stop(self, timeout=None):
+        """Detiene los workers y hace el intento final de lo que siga pendiente (shutdown)."""
+        with pending_lock:
+            self.stopping = True
+            self.ready.notify_all()
+        for t in self.threads:
+            t.join(timeout)
+        with pending_lock:
+            items = list(pending.items())
+            self.heap = []
+        for key, st in items:
+            try:
+                _resolve_final(key, st)
+            except Exception as e:
+                print("resolver shutdown error:", key, e)
+                mark_done(st['ckpt'])
+                tracing.finish(st['trace'], "error")
+        with pending_lock:
+            pending.clear()
+            pending_index.clear()
+            pending_space.notify_all()
+
+resolver = ResolutionScheduler()
+
+def schedule_resolution_and_insert(ev, ckpt=None, trace=None):
     res = normalize_resource(ev.get('resource'))
     for ign in IGNORE_PATTERNS:
         if ign in (res or ''):
             print("Skipping ignore pattern:", res)
+            mark_done(ckpt)
+            tracing.finish(trace, "ignored")
             return
     key, maybe_fid = canonical_key_for_resource(res)
+    if trace:
+        trace.key = key
+        trace.mark("canonicalize")
     with pending_lock:
+        while key not in pending and len(pending) >= MAX_PENDING:
+            pending_space.wait()
         if key in pending:
+            # agrupado con el evento pendiente: si este no llega a escribirse, su propia línea es anterior
             pending[key]['last_seen'] = datetime.utcnow()
+            mark_done(ckpt)
+            tracing.finish(trace, "merged")
             return
-        pending[key] = {'first_seen': datetime.utcnow(), 'last_seen': datetime.utcnow(), 'thread': None, 'ev': ev, 'object_id': maybe_fid}
-    def worker():
-        try:
-            ev_local = ev.copy()
-            object_id = maybe_fid
-            resolved_path = None
-            deadline = datetime.utcnow() + timedelta(seconds=RESOLVE_WAIT)
-            while datetime.utcnow() <= deadline:
-                gu = guess_username(res)
-                if gu:
-                    ev_local['username'] = gu
-                try:
-                    with db_connect() as conn:
-                        if not object_id:
-                            fid,path = find_fileid_and_path(conn, res)
-                            if fid:
-                                object_id = fid
-                                resolved_path = '/' + path if path and not path.startswith('/') else path
-                        else:
-                            # si ya teníamos object_id, obtener path
-                            if not resolved_path:
-                                cur = conn.cursor()
-                                cur.execute("SELECT path FROM oc_filecache WHERE fileid = %s LIMIT 1;", (object_id,))
-                                r = cur.fetchone()
-                                if r and r[0]:
-                                    resolved_path = '/' + r[0] if not r[0].startswith('/') else r[0]
-                        # si hay object_id intentar resolver username
-                        if object_id:
-                            uname = find_username_for_fileid_or_path(conn, object_id, res)
-                        else:
-                            uname = find_username_for_fileid_or_path(conn, None, res)
-                        if uname:
-                            ev_local['username'] = uname
-                            # insertar con resource resuelto si disponible
-                            if _insert_event_db(ev_local, object_id, resolved_path):
-                                print("Inserted (resolved-db canonical):", key, uname, "->", resolved_path or res)
-                                return
-                except Exception as e:
-                    print("worker db resolution error:", e)
-                # si ya tenemos username por guess > insertar ahora
-                if ev_local.get('username'):
-                    if _insert_event_db(ev_local, object_id, resolved_path):
-                        print("Inserted (resolved-early):", key, ev_local.get('username'), "->", resolved_path or res)
-                        return
-                time.sleep(RESOLVE_INTERVAL)
-            # final attempt: guess username and insert
-            final_guess = guess_username(res)
-            if final_guess:
-                ev_local['username'] = final_guess
-            if not resolved_path and object_id:
-                # intentar una última vez obtener path
-                try:
-                    with db_connect() as conn:
-                        cur = conn.cursor()
-                        cur.execute("SELECT path FROM oc_filecache WHERE fileid = %s LIMIT 1;", (object_id,))
-                        r = cur.fetchone()
-                        if r and r[0]:
-                            resolved_path = '/' + r[0] if not r[0].startswith('/') else r[0]
-                except Exception as e:
-                    pass
-            if _insert_event_db(ev_local, object_id, resolved_path):
-                print("Inserted (final canonical):", key, ev_local.get('username'), "->", resolved_path or res)
-        finally:
-            with pending_lock:
-                pending.pop(key, None)
-    t = threading.Thread(target=worker, daemon=True)
-    with pending_lock:
-        pending[key]['thread'] = t
-    t.start()
+        now = time.monotonic()
+        pending[key] = {'first_seen': datetime.utcnow(), 'last_seen': datetime.utcnow(), 'ev': ev.copy(), 'res': res,
+                        'object_id': maybe_fid, 'resolved_path': None, 'ckpt': ckpt, 'trace': trace,
+                        'deadline': now + RESOLVE_WAIT, 'final': False,
+                        'attempts': 0, 'seq': None, 'busy': False, 'wake': False}
+        pending_index.add(res, key)
+        resolver._push(key, now)
 
 # parsers
 def parse_apache_line(line):
+    # la mayoría de las líneas (estáticos, polling de ocs/status) se descartan sin el regex completo
+    if not APACHE_PREFILTER_RE.search(line):
+        return None
     m = APACHE_RE.search(line)
     if not m:
         return None
@@ -415,26 +1728,68 @@ def parse_apache_line(line):
         "raw": line.rstrip("\n")
     }
 
+# solo pueden dar recurso las líneas con una URL de remote.php (el '/' puede venir escapado como '\/')
+# o con path/file/resource en data; el resto (debug, cron, apps) se descarta sin decodificar el JSON
+APP_LINE_MARKERS = ("remote.php", '"path"', '"file"', '"resource"')
+APP_REMOTE_RE = re.compile(r'(/remote.php[^\s,\\"]+)')
+
+if msgspec is not None:
+    class _AppLine(msgspec.Struct):
+        # solo los campos que usa parse_nextcloud_app_line; el resto del objeto se saltea sin construirlo
+        user: object = None
+        uid: object = None
+        user_id: object = None
+        time: object = None
+        message: object = None
+        msg: object = None
+        data: object = None
+        details: object = None
+    _app_line_decoder = msgspec.json.Decoder(_AppLine)
+
+    def _decode_app_line(line):
+        return _app_line_decoder.decode(line)
+else:
+    class _AppLine(dict):
+        __getattr__ = dict.get
+    _loads = orjson.loads if orjson is not None else json.loads
+
+    def _decode_app_line(line):
+        j = _loads(line)
+        return _AppLine(j) if isinstance(j, dict) else None
+
+def _parse_app_time(value):
+    # nextcloud.log usa ISO 8601 (ATOM): fromisoformat es mucho más barato que dateutil
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return dtparser.parse(value)
+
 def parse_nextcloud_app_line(line):
+    if not any(mk in line for mk in APP_LINE_MARKERS):
+        return None
     try:
-        j = json.loads(line)
+        j = _decode_app_line(line)
     except Exception:
         return None
-    user = j.get("user") or j.get("uid") or j.get("user_id") or None
+    if j is None:
+        return None
+    user = j.user or j.uid or j.user_id or None
     ts = None
-    if j.get("time"):
+    if j.time:
         try:
-            ts = dtparser.parse(j.get("time"))
+            ts = _parse_app_time(j.time)
         except Exception:
             ts = datetime.utcnow()
     else:
         ts = datetime.utcnow()
-    message = j.get("message","") or j.get("msg","")
+    message = j.message or j.msg or ""
+    if not isinstance(message, str):
+        message = ""
     resource = None
-    m = re.search(r'(/remote.php[^\s,\\"]+)', message)
+    m = APP_REMOTE_RE.search(message)
     if m:
         resource = m.group(1)
-    data = j.get("data") or j.get("details") or {}
+    data = j.data or j.details or {}
     if isinstance(data, dict):
         if not resource:
             resource = data.get("path") or data.get("file") or data.get("resource")
@@ -443,107 +1798,251 @@ def parse_nextcloud_app_line(line):
     return {"ts": ts, "user": user, "resource": normalize_resource(resource)}
 
 # file handlers
-class AccessHandler(FileSystemEventHandler):
-    def __init__(self, path):
+class TailHandler(FileSystemEventHandler):
+    """
+    Handler de watchdog sobre un LogTailer: cualquier evento del path (modified/created/moved)
+    dispara pump(), que lee todo lo nuevo siguiendo rotaciones. El polling llama a pump() igual.
+    """
+    def __init__(self, path, tracker=None):
         self.path = path
-        self._open()
-    def _open(self):
-        try:
-            self.f = open(self.path, "r", encoding="utf-8", errors="ignore")
-            self.f.seek(0,2)
-        except Exception:
-            self.f = None
-    def on_modified(self, event):
-        if event.src_path != self.path:
+        self.tailer = LogTailer(path)
+        self.lock = threading.Lock()
+        # con checkpoint válido se sigue desde ahí (sin initial scan ni salto al final)
+        self.tracker = tracker
+        saved = checkpoints.get(path) if tracker is not None else None
+        self.resumed = bool(saved) and self.tailer.resume(saved)
+        if self.resumed:
+            print("Resuming %s from checkpoint offset %d" % (path, saved["offset"]))
+    def on_any_event(self, event):
+        if event.src_path != self.path and getattr(event, 'dest_path', None) != self.path:
             return
-        if self.f is None:
-            self._open()
-            if self.f is None:
-                return
-        while True:
-            line = self.f.readline()
-            if not line:
-                break
-            ev = parse_apache_line(line)
-            if ev:
-                schedule_resolution_and_insert(ev)
+        self.pump()
+    def pump(self):
+        # un solo pump a la vez (watchdog y polling) para mantener el orden de las líneas
+        with self.lock:
+            while True:
+                lines = self.tailer.poll()
+                if not lines:
+                    break
+                metrics.LINES_READ.inc(len(lines), log=self.log)
+                if self.tracker is None:
+                    for line in lines:
+                        self.handle_line(line, None)
+                    continue
+                for line, (inode, offset) in zip(lines, self.tailer.positions):
+                    self.handle_line(line, (inode, offset))
+    def handle_line(self, line, pos):
+        raise NotImplementedError
 
-class AppHandler(FileSystemEventHandler):
-    def __init__(self, path):
-        self.path = path
-        self._open()
-    def _open(self):
-        try:
-            self.f = open(self.path, "r", encoding="utf-8", errors="ignore")
-            self.f.seek(0,2)
-        except Exception:
-            self.f = None
-    def on_modified(self, event):
-        if event.src_path != self.path:
-            return
-        if self.f is None:
-            self._open()
-            if self.f is None:
-                return
-        while True:
-            line = self.f.readline()
-            if not line:
-                break
-            parsed = parse_nextcloud_app_line(line)
-            if parsed:
-                add_recent_action(parsed['resource'], parsed['user'], parsed['ts'])
+class AccessHandler(TailHandler):
+    log = "access"
+    def handle_line(self, line, pos):
+        tr = tracing.start()
+        ev = parse_apache_line(line)
+        if ev:
+            metrics.LINES_PARSED.inc(log=self.log)
+            if tr:
+                tr.mark("parse")
+            schedule_resolution_and_insert(ev, self.tracker.begin(pos[0], pos[1], line) if pos else None, tr)
+        elif pos:
+            self.tracker.skip(pos[0], pos[1], line)
+
+class AppHandler(TailHandler):
+    log = "app"
+    def handle_line(self, line, pos):
+        parsed = parse_nextcloud_app_line(line)
+        if parsed:
+            metrics.LINES_PARSED.inc(log=self.log)
+            add_recent_action(parsed['resource'], parsed['user'], parsed['ts'])
+        if pos:
+            # solo memoria de correlación: nada que esperar
+            self.tracker.skip(pos[0], pos[1], line)
+
+def poll_handlers(handlers, interval):
+    # tail por polling: bind mounts / sistemas sin inotify, y red de seguridad en modo auto
+    while True:
+        for h in handlers:
+            try:
+                h.pump()
+            except Exception as e:
+                print("tail poll error:", h.path, e)
+        time.sleep(interval)
 
 # initial scan
-def initial_scan_file(path, handler_parse, limit_lines=2000):
+def _recent_action_sink(parsed):
+    add_recent_action(parsed['resource'], parsed['user'], parsed['ts'])
+
+# timestamps para --since (epoch); None si la línea no tiene
+APACHE_TS_RE = re.compile(r'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4})\]')
+APP_TS_RE = re.compile(r'"time"\s*:\s*"([^"]+)"')
+
+def apache_line_ts(line):
+    m = APACHE_TS_RE.search(line)
+    if not m:
+        return None
     try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as fh:
-            lines = fh.readlines()[-limit_lines:]
-            for L in lines:
-                ev = handler_parse(L)
-                if ev:
-                    schedule_resolution_and_insert(ev)
+        return datetime.strptime(m.group(1), "%d/%b/%Y:%H:%M:%S %z").timestamp()
+    except ValueError:
+        return None
+
+def app_line_ts(line):
+    m = APP_TS_RE.search(line)
+    if not m:
+        return None
+    try:
+        return _ts_epoch(dtparser.parse(m.group(1)))
+    except Exception:
+        return None
+
+# --since (epoch): el initial scan lee desde ese instante en vez de las últimas limit_lines líneas
+scan_since = None
+
+def parse_since(value):
+    """'90m', '2h', '1d' (hacia atrás desde ahora) o un timestamp; naive se toma como UTC."""
+    m = re.match(r'^(\d+)([smhd])$', value.strip())
+    if m:
+        return time.time() - int(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+    return _ts_epoch(dtparser.parse(value))
+
+def initial_scan_file(path, handler_parse, limit_lines=2000, sink=None, line_ts=None):
+    sink = sink or schedule_resolution_and_insert
+    try:
+        # sin leer el archivo entero: bloques desde el final, o búsqueda binaria por timestamp
+        if scan_since is not None and line_ts is not None:
+            lines = lines_since(path, scan_since, line_ts)
+        else:
+            lines = tail_lines(path, limit_lines)
+        for L in lines:
+            ev = handler_parse(L)
+            if ev:
+                sink(ev)
     except FileNotFoundError:
         pass
 
 # main
+_shutdown_done = False
+def shutdown():
+    # pending -> intento final -> writer -> flush síncrono
+    global _shutdown_done
+    if _shutdown_done:
+        return
+    _shutdown_done = True
+    resolver.stop(timeout=RESOLVE_INTERVAL + 5)
+    writer.close()
+    checkpoints.save()
+    tracing.close()
+
+def _on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+def seed_dedupe():
+    try:
+        with db_conn() as conn:
+            print("Dedupe index seeded with", dedupe.seed(conn), "recent events")
+    except Exception as e:
+        print("dedupe seed error:", e)
+
+def start_background_services():
+    # servicios compartidos por ambos motores (threads propios, usan el pool psycopg2)
+    if FILECACHE_MIRROR:
+        filecache_mirror.start()
+    if ACTIVITY_FEED:
+        activity_feed.start()
+    # el índice trigram puede tardar en construirse: no bloquear el arranque
+    threading.Thread(target=setup_filename_lookup, name="filename-lookup-setup", daemon=True).start()
+    if audit_partitioned:
+        threading.Thread(target=partition_maintenance_loop, name="partition-maintenance", daemon=True).start()
+    if METRICS_PORT:
+        try:
+            metrics.start_server(METRICS_ADDR, METRICS_PORT)
+        except Exception as e:
+            print("metrics server error:", e)
+    tracing.setup()
+    # al arrancar y no al importar: una sola serie por cache aunque el módulo se cargue dos veces
+    metrics.cache_stats("path_cache", lambda: (path_cache.hits, path_cache.misses))
+    metrics.cache_stats("filecache_mirror", lambda: (filecache_mirror.hits, filecache_mirror.misses))
+    metrics.cache_stats("activity_feed", lambda: (activity_feed.hits, activity_feed.misses))
+    metrics.cache_stats("resource_key", lambda: canonical_key_for_resource.cache_info()[:2])
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Auditoría de accesos a archivos de Nextcloud (access.log + nextcloud.log).")
+    ap.add_argument("--since", help="initial scan desde este instante ('2h', '30m', '1d' o timestamp) en vez de las "
+                                    "últimas líneas; solo para logs sin checkpoint válido")
+    sub = ap.add_subparsers(dest="command")
+    bf = sub.add_parser("backfill", help="carga masiva de access.log históricos (rotados, comprimidos con gzip/bz2/zstd) y sale")
+    bf.add_argument("--files", nargs="+", required=True, help="access.log* a importar")
+    bf.add_argument("--workers", type=int, default=None, help="procesos de parseo (default: CPUs)")
+    bf.add_argument("--batch", type=int, default=None, help="eventos por lote de COPY + resolución (BACKFILL_BATCH)")
+    return ap.parse_args()
+
 def main():
+    global scan_since
+    args = parse_args()
+    if args.command == "backfill":
+        import backfill
+        return backfill.run(args.files, workers=args.workers, batch=args.batch or backfill.BACKFILL_BATCH)
+    if args.since:
+        scan_since = parse_since(args.since)
+    if AUDIT_ENGINE == "asyncio":
+        import async_engine
+        return async_engine.main()
     print("Audit starting. ACCESS_LOG=", ACCESS_LOG, "APP_LOG=", NEXTCLOUD_APP_LOG)
     ensure_table()
-    # preload recent actions to help guess usernames quickly
-    try:
-        initial_scan_file(NEXTCLOUD_APP_LOG, parse_nextcloud_app_line, limit_lines=2000)
-    except Exception:
-        pass
-    initial_scan_file(ACCESS_LOG, parse_apache_line, limit_lines=1000)
-    obs = Observer()
-    started_any = False
-    try:
-        if os.path.exists(NEXTCLOUD_APP_LOG):
-            ah = AppHandler(NEXTCLOUD_APP_LOG)
-            obs.schedule(ah, path=os.path.dirname(NEXTCLOUD_APP_LOG) or ".", recursive=False)
-            started_any = True
-            print("Watching app log:", NEXTCLOUD_APP_LOG)
-    except Exception as e:
-        print("Error scheduling app log watch:", e)
-    try:
-        if os.path.exists(ACCESS_LOG):
-            ah2 = AccessHandler(ACCESS_LOG)
-            obs.schedule(ah2, path=os.path.dirname(ACCESS_LOG) or ".", recursive=False)
-            started_any = True
-            print("Watching access log:", ACCESS_LOG)
-    except Exception as e:
-        print("Error scheduling access log watch:", e)
-    if not started_any:
+    seed_dedupe()
+    writer.start()
+    resolver.start()
+    resolution_wakers.append(resolver.wake)
+    metrics.PENDING.register(lambda: len(pending))
+    start_background_services()
+    atexit.register(shutdown)
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    checkpoints.load()
+    handlers = []
+    for path, cls, label in ((NEXTCLOUD_APP_LOG, AppHandler, "app log"), (ACCESS_LOG, AccessHandler, "access log")):
+        try:
+            if os.path.exists(path):
+                handlers.append(cls(path, checkpoints.tracker(path)))
+                print("Watching %s:" % label, path)
+        except Exception as e:
+            print("Error scheduling %s watch:" % label, e)
+    # sin checkpoint (primer arranque o log irreconocible): como antes, últimas líneas y luego desde el final
+    resumed = set(h.path for h in handlers if h.resumed)
+    if NEXTCLOUD_APP_LOG not in resumed:
+        # preload recent actions to help guess usernames quickly
+        try:
+            initial_scan_file(NEXTCLOUD_APP_LOG, parse_nextcloud_app_line, limit_lines=2000, sink=_recent_action_sink,
+                              line_ts=app_line_ts)
+        except Exception:
+            pass
+    if ACCESS_LOG not in resumed:
+        initial_scan_file(ACCESS_LOG, parse_apache_line, limit_lines=1000, line_ts=apache_line_ts)
+    if not handlers:
         print("No logs to watch. Sleeping.")
         while True:
             time.sleep(60)
-    obs.start()
+    obs = None
+    poll_interval = TAIL_POLL_INTERVAL
+    if TAIL_MODE in ("auto", "inotify"):
+        try:
+            obs = Observer()
+            for h in handlers:
+                obs.schedule(h, path=os.path.dirname(h.path) or ".", recursive=False)
+            obs.start()
+            # con inotify el polling queda solo como red de seguridad (modo auto)
+            poll_interval = TAIL_POLL_FALLBACK if TAIL_MODE == "auto" else None
+        except Exception as e:
+            print("inotify watch unavailable, falling back to polling:", e)
+            obs = None
+    if poll_interval:
+        threading.Thread(target=poll_handlers, args=(handlers, poll_interval), name="tail-poll", daemon=True).start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        obs.stop()
-    obs.join()
+        if obs is not None:
+            obs.stop()
+    if obs is not None:
+        obs.join()
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+log_ingest.py - lectura de logs para log_audit.
+LogTailer: tail por bytes que sigue el inode del path; detecta rotación (logrotate create/move)
+y truncado (copytruncate), drena el archivo rotado antes de cambiar y lee en bloques grandes.
+Lo usan los handlers de watchdog, el tail por polling (sin inotify) y el motor asyncio.
+Checkpoints: por log, (inode, offset, hash de la última línea) hasta donde todo lo leído
+ya quedó escrito en la DB (o descartado); al reiniciar se retoma desde ahí.
+tail_lines / lines_since: lectura del final del log para el initial scan sin cargar el archivo
+entero (bloques hacia atrás, o búsqueda binaria por timestamp).
+open_log: logs rotados comprimidos (gzip, bz2, zstd si está instalado zstandard) detectados por
+magic bytes y descomprimidos en streaming, sin pasar por disco.
+"""
+import os, io, json, bz2, gzip, hashlib, threading
+from collections import deque
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+TAIL_CHUNK = int(os.getenv("TAIL_CHUNK", str(1 << 16)))
+# máximo de bytes por llamada a poll(); el llamador repite hasta que no haya más
+TAIL_MAX_READ = int(os.getenv("TAIL_MAX_READ", str(4 << 20)))
+
+class LogTailer:
+    def __init__(self, path, chunk_size=TAIL_CHUNK):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.f = None
+        self.inode = None
+        self.dev = None
+        self.offset = 0
+        self.buf = b''
+        self.more = False
+        # (inode, offset final) de cada línea devuelta por el último poll(), para los checkpoints
+        self.positions = []
+        self.lock = threading.Lock()
+        # como antes: si el archivo ya existe se abre ya en su final (lo escrito después de crear el
+        # tailer no se pierde aunque el primer poll() llegue tarde); si aparece después, desde el principio
+        self._open(seek_end=True)
+
+    def _open(self, seek_end):
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return False
+        st = os.fstat(f.fileno())
+        self.f, self.inode, self.dev = f, st.st_ino, st.st_dev
+        self.offset = f.seek(0, 2) if seek_end else 0
+        self.buf = b''
+        return True
+
+    def resume(self, state):
+        """
+        Retoma desde un checkpoint {inode, offset, hash}: en el path o, si se rotó mientras el servicio
+        estaba caído, en el rotado (.1), siempre que el inode coincida y la última línea leída siga ahí.
+        """
+        with self.lock:
+            offset = state.get("offset") or 0
+            for cand in (self.path, self.path + ".1"):
+                try:
+                    f = open(cand, "rb")
+                except OSError:
+                    continue
+                st = os.fstat(f.fileno())
+                if st.st_ino == state.get("inode") and st.st_size >= offset and _hash_before(f, offset) == state.get("hash"):
+                    if self.f is not None:
+                        self.f.close()
+                    self.f, self.inode, self.dev = f, st.st_ino, st.st_dev
+                    self.offset = f.seek(offset)
+                    self.buf = b''
+                    return True
+                f.close()
+            return False
+
+    def _read(self, out, max_bytes):
+        read = 0
+        self.more = False
+        while True:
+            if read >= max_bytes:
+                self.more = True
+                return
+            chunk = self.f.read(self.chunk_size)
+            if not chunk:
+                return
+            read += len(chunk)
+            pos = self.offset - len(self.buf)
+            self.offset += len(chunk)
+            lines = (self.buf + chunk).split(b'\n')
+            self.buf = lines.pop()
+            for line in lines:
+                pos += len(line) + 1
+                out.append(line.decode("utf-8", "ignore") + "\n")
+                self.positions.append((self.inode, pos))
+
+    def _flush_partial(self, out):
+        # última línea sin '\n' del archivo rotado
+        if self.buf:
+            out.append(self.buf.decode("utf-8", "ignore") + "\n")
+            self.positions.append((self.inode, self.offset))
+            self.buf = b''
+
+    def poll(self, max_bytes=TAIL_MAX_READ):
+        """Devuelve las líneas completas nuevas (hasta ~max_bytes); [] si no hay nada."""
+        with self.lock:
+            out = []
+            self.positions = []
+            if self.f is None:
+                if not self._open(seek_end=False):
+                    return out
+            self._read(out, max_bytes)
+            if self.more:
+                return out
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                # rotado y todavía no recreado: seguir con el fd actual
+                return out
+            if st.st_ino != self.inode or st.st_dev != self.dev:
+                # rotación: el archivo viejo ya quedó drenado arriba, seguir con el nuevo desde 0
+                self._flush_partial(out)
+                self.f.close()
+                self.f = None
+                if self._open(seek_end=False):
+                    self._read(out, max_bytes)
+            elif st.st_size < self.offset:
+                # truncado (copytruncate)
+                self.f.seek(0)
+                self.offset = 0
+                self.buf = b''
+                self._read(out, max_bytes)
+            return out
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def log_compression(path):
+    """'gzip' | 'bz2' | 'zstd' | None según los primeros bytes (no la extensión)."""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(BZ2_MAGIC):
+        return "bz2"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+def open_log(path):
+    """Log (plano o comprimido) para lectura secuencial en texto; la descompresión es en streaming."""
+    kind = log_compression(path)
+    if kind == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8", errors="ignore")
+    if kind == "bz2":
+        return bz2.open(path, "rt", encoding="utf-8", errors="ignore")
+    if kind == "zstd":
+        if zstandard is None:
+            raise RuntimeError("%s is zstd-compressed and the zstandard module is not installed" % path)
+        # zstd de logrotate/cat puede traer varios frames concatenados: leer todos, no solo el primero
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True, read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding="utf-8", errors="ignore")
+    return open(path, "r", encoding="utf-8", errors="ignore")
+
+def reverse_lines(f, block_size=TAIL_CHUNK):
+    """Líneas del archivo (binario) de la última a la primera, leyendo bloques desde el final."""
+    pos = f.seek(0, 2)
+    buf = b''
+    first = True
+    while pos > 0:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        parts = (f.read(step) + buf).split(b'\n')
+        buf = parts[0]
+        if first:
+            # el '\n' final del archivo no abre una línea vacía
+            if parts[-1] == b'':
+                parts.pop()
+            first = False
+        for line in reversed(parts[1:]):
+            yield line
+    if buf or not first:
+        yield buf
+
+def tail_lines(path, n, block_size=TAIL_CHUNK):
+    """Últimas n líneas en orden, con memoria proporcional a n y no al tamaño del log."""
+    out = []
+    if n <= 0:
+        return out
+    if log_compression(path):
+        # comprimido: no se puede leer hacia atrás, se recorre en streaming quedándose con n
+        with open_log(path) as fh:
+            return [line if line.endswith("\n") else line + "\n" for line in deque(fh, maxlen=n)]
+    with open(path, "rb") as f:
+        for line in reverse_lines(f, block_size):
+            out.append(line.decode("utf-8", "ignore") + "\n")
+            if len(out) >= n:
+                break
+    out.reverse()
+    return out
+
+def _line_from(f, pos):
+    # (inicio, línea) de la primera línea que empieza en pos o después
+    if pos > 0:
+        f.seek(pos - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    start = f.tell()
+    return start, f.readline()
+
+def offset_since(f, since, line_ts):
+    """
+    Offset de la primera línea con line_ts(línea) >= since (epoch), por búsqueda binaria sobre
+    los bytes del archivo: supone timestamps (casi) crecientes, como en access.log o nextcloud.log.
+    Las líneas sin timestamp se saltan hasta la siguiente que lo tenga.
+    """
+    lo, hi = 0, f.seek(0, 2)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start, line = _line_from(f, mid)
+        ts = None
+        while line and start < hi:
+            ts = line_ts(line.decode("utf-8", "ignore"))
+            if ts is not None:
+                break
+            start += len(line)
+            line = f.readline()
+        if ts is None or start >= hi:
+            hi = mid
+        elif ts < since:
+            lo = start + len(line)
+        else:
+            hi = mid
+    return _line_from(f, lo)[0]
+
+def lines_since(path, since, line_ts):
+    """Líneas (en orden) desde la primera con timestamp >= since hasta el final actual del archivo."""
+    if log_compression(path):
+        # comprimido: sin búsqueda binaria, se descartan en streaming las líneas anteriores
+        with open_log(path) as fh:
+            found = False
+            for line in fh:
+                if not found:
+                    ts = line_ts(line)
+                    if ts is None or ts < since:
+                        continue
+                    found = True
+                yield line
+        return
+    with open(path, "rb") as f:
+        f.seek(offset_since(f, since, line_ts))
+        for line in f:
+            yield line.decode("utf-8", "ignore")
+
+def line_hash(line):
+    return hashlib.sha1(line.rstrip("\n").encode("utf-8")).hexdigest()
+
+def _hash_before(f, offset):
+    # hash de la línea que termina en offset (la última procesada según el checkpoint)
+    if offset <= 0:
+        return None
+    start = max(0, offset - (1 << 20))
+    f.seek(start)
+    data = f.read(offset - start)
+    if data.endswith(b'\n'):
+        data = data[:-1]
+    return line_hash(data[data.rfind(b'\n') + 1:].decode("utf-8", "ignore"))
+
+class OffsetTracker:
+    """
+    Posiciones en vuelo de un log, en orden de lectura. Cada línea tiene una marca que se cierra
+    cuando su evento quedó escrito (o se descartó); el checkpoint avanza hasta la primera abierta.
+    """
+    def __init__(self):
+        self.marks = deque()
+        self.committed = None
+        self.lock = threading.Lock()
+
+    def begin(self, inode, offset, line):
+        mark = [self, inode, offset, line, False]
+        with self.lock:
+            self.marks.append(mark)
+        return mark
+
+    def skip(self, inode, offset, line):
+        # línea que no genera evento: cerrada desde el principio
+        with self.lock:
+            if self.marks:
+                self.marks.append([self, inode, offset, line, True])
+            else:
+                self.committed = (inode, offset, line)
+
+    def done(self, mark):
+        with self.lock:
+            mark[4] = True
+            while self.marks and self.marks[0][4]:
+                m = self.marks.popleft()
+                self.committed = (m[1], m[2], m[3])
+
+def mark_done(*marks):
+    for m in marks:
+        if m is not None:
+            m[0].done(m)
+
+class Checkpoints:
+    """Archivo JSON con el checkpoint de cada log vigilado; save() lo reescribe (atómico) si cambió."""
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self.trackers = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path) as fh:
+                self.state = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("checkpoint load error:", e)
+
+    def get(self, log_path):
+        return self.state.get(log_path) if self.path else None
+
+    def tracker(self, log_path):
+        if not self.path:
+            return None
+        with self.lock:
+            return self.trackers.setdefault(log_path, OffsetTracker())
+
+    def save(self):
+        with self.lock:
+            changed = False
+            for log_path, tr in self.trackers.items():
+                c = tr.committed
+                if c is None:
+                    continue
+                st = {"inode": c[0], "offset": c[1], "hash": line_hash(c[2])}
+                if self.state.get(log_path) != st:
+                    self.state[log_path] = st
+                    changed = True
+            if not changed:
+                return
+            try:
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as fh:
+                    json.dump(self.state, fh)
+                os.replace(tmp, self.path)
+            except Exception as e:
+                print("checkpoint save error:", e)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+metrics.py - métricas del servicio de auditoría en formato de texto de Prometheus.
+Sin dependencias: contadores, histogramas y valores calculados al momento del scrape,
+servidos por http.server en un thread (GET /metrics). Los comparten ambos motores.
+"""
+import asyncio, functools, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RESOLUTION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_registry = []
+_lock = threading.Lock()
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+def _fmt_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, n=1, **labels):
+        key = tuple(labels[l] for l in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        out = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with _lock:
+            items = sorted(self.values.items())
+        for key, v in items:
+            out.append("%s%s %s" % (self.name, _fmt_labels(self.labels, key), _fmt_value(v)))
+        return out
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}   # labels -> [counts por bucket..., +Inf], sum
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[l] for l in self.labels)
+        with _lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    v[0][i] += 1
+                    break
+            else:
+                v[0][-1] += 1
+            v[1] += value
+
+    def render(self):
+        out = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with _lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+        for key, (counts, total) in items:
+            acc = 0
+            for b, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                out.append("%s_bucket%s %d" % (self.name, _fmt_labels(self.labels, key, ("le", b)), acc))
+            out.append("%s_sum%s %s" % (self.name, _fmt_labels(self.labels, key), repr(total)))
+            out.append("%s_count%s %d" % (self.name, _fmt_labels(self.labels, key), acc))
+        return out
+
+class Collected:
+    """Valor(es) calculados en el scrape: fn() devuelve un número o una lista de (dict de labels, valor)."""
+    def __init__(self, name, help, kind="gauge", labels=()):
+        self.name, self.help, self.kind, self.labels = name, help, kind, tuple(labels)
+        self.fns = []
+        _registry.append(self)
+
+    def register(self, fn):
+        self.fns.append(fn)
+
+    def render(self):
+        out = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for fn in self.fns:
+            try:
+                r = fn()
+            except Exception:
+                continue
+            if isinstance(r, (int, float)):
+                r = [({}, r)]
+            for labels, v in r:
+                out.append("%s%s %s" % (self.name, _fmt_labels(self.labels, [labels.get(l, "") for l in self.labels]), _fmt_value(v)))
+        return out
+
+# --- métricas del servicio ---
+LINES_READ = Counter("audit_log_lines_total", "Lines read from each watched log.", ["log"])
+LINES_PARSED = Counter("audit_log_lines_parsed_total", "Lines that produced an event (parse hit ratio = parsed / lines).", ["log"])
+PENDING = Collected("audit_pending", "Keys waiting for resolution (len(pending)).")
+RESOLUTION_SECONDS = Histogram("audit_resolution_seconds", "Time from first sighting of a key to its insert or drop.",
+                               ["outcome"], RESOLUTION_BUCKETS)
+RESOLUTION_ATTEMPTS = Counter("audit_resolution_attempts_total", "Resolution attempts (one per pending key per scheduled or woken try).")
+RESOLUTION_WAKEUPS = Counter("audit_resolution_wakeups_total", "Pending keys woken early by a matching nextcloud.log action.")
+DB_QUERY_SECONDS = Histogram("audit_db_query_seconds", "Latency of DB helper calls.", ["helper"])
+INSERT_BATCH_SIZE = Histogram("audit_insert_batch_size", "Rows per writer flush.", buckets=BATCH_BUCKETS)
+INSERT_FAILED = Counter("audit_insert_failed_total", "Events dropped because their row could not be inserted (bad data).")
+DEDUPE_DROPPED = Counter("audit_dedupe_dropped_total", "Events dropped as duplicates.", ["stage"])
+CACHE_HITS = Collected("audit_cache_hits_total", "Cache hits.", "counter", ["cache"])
+CACHE_MISSES = Collected("audit_cache_misses_total", "Cache misses.", "counter", ["cache"])
+
+def timed(helper):
+    """Decorador: registra la duración de la función (sync o async) en DB_QUERY_SECONDS{helper}."""
+    def deco(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*a, **kw):
+                t0 = time.perf_counter()
+                try:
+                    return await fn(*a, **kw)
+                finally:
+                    DB_QUERY_SECONDS.observe(time.perf_counter() - t0, helper=helper)
+            return awrapper
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - t0, helper=helper)
+        return wrapper
+    return deco
+
+def cache_stats(name, fn):
+    """fn() -> (hits, misses) de un cache; se lee en cada scrape."""
+    CACHE_HITS.register(lambda: [({"cache": name}, fn()[0])])
+    CACHE_MISSES.register(lambda: [({"cache": name}, fn()[1])])
+
+def render():
+    out = []
+    for m in _registry:
+        out.extend(m.render())
+    return "\n".join(out) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # sin una línea por scrape en la salida del servicio
+        pass
+
+def start_server(addr, port):
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print("Metrics on http://%s:%d/metrics" % server.server_address[:2])
+    return server
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+resource_key.py - canonicalización de recursos para log_audit.
+normalize_resource, canonical_key_for_resource y detect_event_type comparten imports a nivel
+de módulo, regex precompiladas y un memo LRU por URL cruda: las mismas URLs (el mismo archivo
+abierto, descargado, previsualizado) se repiten mucho en el access log.
+"""
+import os, re
+from functools import lru_cache
+from urllib.parse import unquote, urlparse, parse_qs
+
+RESOURCE_KEY_CACHE = int(os.getenv("RESOURCE_KEY_CACHE","65536"))
+
+FILE_EXT_RE = re.compile(r'\.(pdf|docx?|xlsx?|pptx?|txt|odt|ods|jpg|jpeg|png|zip|rar|7z)(?:$|\?)', re.IGNORECASE)
+
+# una sola pasada con la prioridad de antes: fileId=N, si no /download/N, si no /wopi/files/N_
+# (cada lookahead busca la primera ocurrencia en todo el string, como los re.search en secuencia)
+CANONICAL_ID_RE = re.compile(r'^(?:(?=.*?fileId=(\d+))|(?=.*?/download/(\d+))|(?=.*?/wopi/files/(\d+)_))', re.DOTALL)
+
+@lru_cache(maxsize=RESOURCE_KEY_CACHE)
+def normalize_resource(r):
+    if not r:
+        return r
+    return unquote(r.split('?', 1)[0]).rstrip('/')
+
+@lru_cache(maxsize=RESOURCE_KEY_CACHE)
+def canonical_key_for_resource(resource):
+    res = normalize_resource(resource or '')
+    m = CANONICAL_ID_RE.match(res)
+    if m:
+        fid = int(m.group(1) or m.group(2) or m.group(3))
+        return ("fileid:%d" % fid, fid)
+    return ("resource:%s" % res, None)
+
+@lru_cache(maxsize=RESOURCE_KEY_CACHE)
+def _resource_hints(resource):
+    # (pista de descarga en path/query, extensión de archivo conocida) de la URL
+    try:
+        up = urlparse(resource)
+        qs = parse_qs(up.query or "")
+        path = up.path or resource
+    except Exception:
+        path = resource; qs = {}
+    download = 'download' in (path or "").lower() or 'download' in (",".join(qs.keys()).lower())
+    return download, bool(FILE_EXT_RE.search(path or ""))
+
+def detect_event_type(method, status, resource):
+    download, file_ext = _resource_hints(resource)
+    m = method.upper()
+    if download:
+        return "download"
+    if m == "PROPFIND":
+        return "list"
+    if m == "GET" and status == 200 and file_ext:
+        return "download"
+    if m == "GET" and status == 200:
+        return "view"
+    return "other"
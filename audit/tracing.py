@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+tracing.py - latencia por etapa del ciclo de vida de un evento del access log, por muestreo.
+Etapas: parse -> canonicalize -> pending (hasta el primer intento) -> resolve (cada intento; entre
+reintentos, wait) -> dedupe -> queue (cola del writer) -> insert (flush + commit).
+Con TRACE_SAMPLE=0 (default) start() devuelve None y cada punto de medición es un `if tr:`.
+Los eventos muestreados alimentan p50/p95/p99 por etapa (se imprimen cada TRACE_REPORT_INTERVAL
+y se exportan en /metrics) y, con TRACE_FILE, una línea JSON con los spans de cada evento.
+"""
+import os, json, random, threading, time, itertools
+from collections import deque
+
+import metrics
+
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE","0"))
+TRACE_FILE = os.getenv("TRACE_FILE","")
+TRACE_REPORT_INTERVAL = int(os.getenv("TRACE_REPORT_INTERVAL","60"))
+# duraciones guardadas por etapa para los percentiles
+TRACE_RESERVOIR = int(os.getenv("TRACE_RESERVOIR","10000"))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_durations = {}     # etapa -> deque de segundos
+_outcomes = {}
+_file = None
+
+class Trace:
+    __slots__ = ('id', 'wall', 't0', 'last', 'spans', 'key', 'attempts')
+    def __init__(self):
+        self.id = next(_ids)
+        self.wall = time.time()
+        self.t0 = self.last = time.monotonic()
+        self.spans = []
+        self.key = None
+        self.attempts = 0
+
+    def mark(self, stage):
+        """Cierra la etapa `stage` (desde la marca anterior hasta ahora)."""
+        now = time.monotonic()
+        self.spans.append((stage, self.last - self.t0, now - self.last))
+        self.last = now
+
+    def attempt(self):
+        """Empieza un intento de resolución: cierra 'pending' (el primero) o 'wait' (entre reintentos)."""
+        self.mark("wait" if self.attempts else "pending")
+        self.attempts += 1
+
+def start():
+    if TRACE_SAMPLE <= 0 or random.random() >= TRACE_SAMPLE:
+        return None
+    return Trace()
+
+def finish(tr, outcome):
+    if tr is None:
+        return
+    total = time.monotonic() - tr.t0
+    stages = {}
+    for stage, _, dur in tr.spans:
+        stages[stage] = stages.get(stage, 0.0) + dur
+    with _lock:
+        for stage, dur in itertools.chain(stages.items(), (("total", total),)):
+            d = _durations.get(stage)
+            if d is None:
+                d = _durations[stage] = deque(maxlen=TRACE_RESERVOIR)
+            d.append(dur)
+        _outcomes[outcome] = _outcomes.get(outcome, 0) + 1
+        if _file is not None:
+            try:
+                _file.write(json.dumps({
+                    "trace": tr.id, "ts": tr.wall, "key": tr.key, "outcome": outcome, "attempts": tr.attempts, "total_ms": round(total * 1000, 3),
+                    "spans": [{"name": s, "start_ms": round(st * 1000, 3), "dur_ms": round(d * 1000, 3)} for s, st, d in tr.spans],
+                }) + "\n")
+            except Exception as e:
+                print("trace file error:", e)
+
+def _quantile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summary():
+    """{etapa: (n, p50, p95, p99)} en segundos sobre las últimas TRACE_RESERVOIR muestras."""
+    with _lock:
+        data = dict((stage, sorted(d)) for stage, d in _durations.items() if d)
+    return dict((stage, (len(v),) + tuple(_quantile(v, q) for q in QUANTILES)) for stage, v in data.items())
+
+def _summary_metrics():
+    out = []
+    for stage, (n, *qs) in summary().items():
+        for q, v in zip(QUANTILES, qs):
+            out.append(({"stage": stage, "quantile": str(q)}, v))
+    return out
+
+def report():
+    s = summary()
+    if not s:
+        return
+    with _lock:
+        outcomes = ", ".join("%s=%d" % kv for kv in sorted(_outcomes.items()))
+    print("trace summary (%s):" % outcomes)
+    for stage, (n, p50, p95, p99) in sorted(s.items(), key=lambda kv: kv[0] == "total"):
+        print("  %-13s n=%-6d p50=%8.1fms p95=%8.1fms p99=%8.1fms" % (stage, n, p50 * 1000, p95 * 1000, p99 * 1000))
+
+def _report_loop():
+    while True:
+        time.sleep(TRACE_REPORT_INTERVAL)
+        report()
+        if _file is not None:
+            with _lock:
+                _file.flush()
+
+STAGE_SECONDS = metrics.Collected("audit_trace_stage_seconds", "Per-stage latency quantiles of sampled events (TRACE_SAMPLE).",
+                                  "gauge", ["stage", "quantile"])
+
+def setup():
+    """Abre TRACE_FILE y arranca el reporte periódico si hay muestreo."""
+    global _file
+    if TRACE_SAMPLE <= 0:
+        return
+    if TRACE_FILE:
+        try:
+            _file = open(TRACE_FILE, "a", buffering=1 << 16)
+        except Exception as e:
+            print("trace file error:", e)
+    STAGE_SECONDS.register(_summary_metrics)
+    threading.Thread(target=_report_loop, name="trace-report", daemon=True).start()
+    print("Tracing %.2f%% of events%s" % (TRACE_SAMPLE * 100, " -> " + TRACE_FILE if _file else ""))
+
+def close():
+    report()
+    with _lock:
+        if _file is not None:
+            _file.flush()